@@ -30,9 +30,12 @@ settings = dict(
 def make_app():
     from backend.webInterface import tr_run
     from backend.webInterface import tr_index
+    from backend.webInterface import tr_ready
 
     return tornado.web.Application([
         (r"/api/tr-run/", tr_run.TrRun),
+        (r"/api/tr-run-batch/?", tr_run.TrRunBatch),
+        (r"/api/ready/?", tr_ready.TrReady),
         (r"/", tr_index.Index),
         (r"/(.*)", StaticFileHandler,
          {"path": os.path.join(current_path, "dist/TrWebOcr_fontend"), "default_filename": "index.html"}),
@@ -40,9 +43,35 @@ def make_app():
     ], **settings)
 
 
+def serve(port, sessions=1):
+    from backend.webInterface import tr_run
+    tr_run.init_ocr_workers(sessions)
+    app = make_app()
+
+    server = tornado.httpserver.HTTPServer(app)
+    # server.listen(port)
+    server.bind(port)
+    server.start(1)
+    print(f'Server is running: http://{host_ip()}:{port}')
+    print(f'Now version is: {manage_running_platform.get_run_version()}')
+
+    # 先开始监听，再在OCR线程池里预热模型；预热完成前 /api/ready 返回503
+    from backend.webInterface import tr_ready
+    tornado.ioloop.IOLoop.current().run_in_executor(tr_run.ocr_executor, tr_ready.warmup)
+
+    # tornado.ioloop.IOLoop.instance().start()
+    tornado.ioloop.IOLoop.current().start()
+
+
 if __name__ == "__main__":
     define("port", default=8089, type=int, help='指定运行时端口号')
     define("open_gpu", default=0, type=int, help='是否开启gpu')
+    define("sessions", default=1, type=int, help='进程内native session数量，即可同时进行的OCR数量')
+    define("orientation", default='probe', type=str, help='默认的方向判定策略: sequential/probe/speculative')
+    define("max_size", default=0, type=int, help='解码后图片的最长边，0表示不压缩；请求的compress参数可以覆盖')
+    define("detect_size", default=1600, type=int, help='检测时图片的最长边，识别仍使用原图；0表示在原图上检测')
+    define("tile_size", default=0, type=int, help='检测图最长边超过该值时分块检测；0表示不分块')
+    define("tile_overlap", default=200, type=int, help='分块检测时相邻块的重叠宽度')
 
     tornado.options.parse_command_line()
     port = options.port
@@ -52,14 +81,11 @@ if __name__ == "__main__":
         manage_running_platform.change_version('cpu')
     else:
         manage_running_platform.change_version('gpu')
-    app = make_app()
-
-    server = tornado.httpserver.HTTPServer(app)
-    # server.listen(port)
-    server.bind(port)
-    server.start(1)
-    print(f'Server is running: http://{host_ip()}:{port}')
-    print(f'Now version is: {manage_running_platform.get_run_version()}')
 
-    # tornado.ioloop.IOLoop.instance().start()
-    tornado.ioloop.IOLoop.current().start()
+    from backend.tools import orientation, preprocess, tiling
+    orientation.default_strategy = options.orientation
+    orientation.detect_size = options.detect_size
+    preprocess.default_max_size = options.max_size
+    tiling.tile_size = options.tile_size
+    tiling.tile_overlap = options.tile_overlap
+    serve(port, options.sessions)
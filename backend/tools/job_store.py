@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+    网关的异步任务队列：提交的任务连同图片一起写入本地SQLite文件，网关重启或子进程回收都不会丢失
+
+    一个任务包含一张或多张图片，每张图片是一个条目(item)，按提交顺序被领取；
+    领取后状态为running，网关异常退出后重启时重新排队。条目完成后删除图片内容，只保留结果
+'''
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+
+
+class JobStore:
+    '''
+    SQLite是同步接口，网关应在线程池中调用
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.submitted = 0
+        self.retried = 0
+        self.completed = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                id TEXT PRIMARY KEY,
+                                status TEXT NOT NULL,
+                                params TEXT NOT NULL,
+                                bypass INTEGER NOT NULL,
+                                webhook TEXT,
+                                webhook_state TEXT,
+                                total INTEGER NOT NULL,
+                                completed INTEGER NOT NULL DEFAULT 0,
+                                failed INTEGER NOT NULL DEFAULT 0,
+                                created REAL NOT NULL,
+                                started REAL,
+                                finished REAL)''')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS items (
+                                job_id TEXT NOT NULL,
+                                idx INTEGER NOT NULL,
+                                name TEXT NOT NULL,
+                                data BLOB,
+                                status TEXT NOT NULL,
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                status_code INTEGER,
+                                result BLOB,
+                                elapsed REAL,
+                                PRIMARY KEY (job_id, idx))''')
+        # 按rowid（提交顺序）领取排队中的条目
+        self._db.execute('CREATE INDEX IF NOT EXISTS items_status ON items (status)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished)')
+
+    def submit(self, images, params, bypass=False, webhook=None):
+        '''
+        :param images: [(name, bytes)]
+        :param params: [(name, bytes)]，应用到每张图片的表单参数
+        :return: 任务id
+        '''
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        params = json.dumps([[name, value.decode()] for name, value in params])
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                self._db.execute('INSERT INTO jobs (id, status, params, bypass, webhook, total, created) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (job_id, QUEUED, params, int(bypass), webhook, len(images), now))
+                self._db.executemany('INSERT INTO items (job_id, idx, name, data, status) VALUES (?, ?, ?, ?, ?)',
+                                     [(job_id, index, name, data, QUEUED) for index, (name, data) in enumerate(images)])
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self.submitted += 1
+        return job_id
+
+    def claim(self):
+        '''
+        领取最早提交的一个排队条目
+        :return: (job_id, index, name, data, params, bypass, attempts)，没有排队条目时返回None
+        '''
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT job_id, idx, name, data, attempts FROM items WHERE status = ? '
+                                   'ORDER BY rowid LIMIT 1', (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            job_id, index, name, data, attempts = row
+            self._db.execute('UPDATE items SET status = ?, attempts = attempts + 1 WHERE job_id = ? AND idx = ?',
+                             (RUNNING, job_id, index))
+            self._db.execute('UPDATE jobs SET status = ?, started = COALESCE(started, ?) WHERE id = ? AND status = ?',
+                             (RUNNING, now, job_id, QUEUED))
+            params, bypass = self._db.execute('SELECT params, bypass FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        params = [(name, value.encode()) for name, value in json.loads(params)]
+        return job_id, index, name, data, params, bool(bypass), attempts + 1
+
+    def retry(self, job_id, index):
+        with self._lock:
+            self._db.execute('UPDATE items SET status = ? WHERE job_id = ? AND idx = ?', (QUEUED, job_id, index))
+            self.retried += 1
+
+    def finish(self, job_id, index, status_code, result, elapsed):
+        '''
+        记录条目的结果
+        :return: 任务因此完成时返回任务信息（见get），否则返回None
+        '''
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                self._db.execute('UPDATE items SET status = ?, status_code = ?, result = ?, elapsed = ?, data = NULL '
+                                 'WHERE job_id = ? AND idx = ?', (DONE, status_code, result, elapsed, job_id, index))
+                self._db.execute('UPDATE jobs SET completed = completed + 1, failed = failed + ? WHERE id = ?',
+                                 (int(status_code != 200), job_id))
+                finished = self._db.execute('UPDATE jobs SET status = ?, finished = ?, '
+                                            'webhook_state = CASE WHEN webhook IS NULL THEN NULL ELSE ? END '
+                                            'WHERE id = ? AND completed = total', (DONE, now, 'pending', job_id)).rowcount
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            if not finished:
+                return None
+            self.completed += 1
+            return self._get(job_id)
+
+    def _get(self, job_id):
+        row = self._db.execute('SELECT id, status, total, completed, failed, created, started, finished, '
+                               'webhook, webhook_state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ('job_id', 'status', 'total', 'completed', 'failed', 'created', 'started', 'finished',
+                'webhook', 'webhook_state')
+        return dict(zip(keys, row))
+
+    def get(self, job_id):
+        '''
+        :return: 任务状态和进度，不存在时返回None
+        '''
+        with self._lock:
+            return self._get(job_id)
+
+    def results(self, job_id):
+        '''
+        :return: 已完成条目的 [(index, name, status_code, result, elapsed)]
+        '''
+        with self._lock:
+            return self._db.execute('SELECT idx, name, status_code, result, elapsed FROM items '
+                                    'WHERE job_id = ? AND status = ? ORDER BY idx', (job_id, DONE)).fetchall()
+
+    def pending_webhooks(self):
+        '''
+        :return: 已完成但回调尚未送达的任务id
+        '''
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT id FROM jobs WHERE webhook_state = ?', ('pending',))]
+
+    def set_webhook_state(self, job_id, state):
+        with self._lock:
+            self._db.execute('UPDATE jobs SET webhook_state = ? WHERE id = ?', (state, job_id))
+
+    def recover(self):
+        '''
+        启动时调用：上次退出时领取了但没有完成的条目重新排队
+        :return: 重新排队的条目数
+        '''
+        with self._lock:
+            return self._db.execute('UPDATE items SET status = ? WHERE status = ?', (QUEUED, RUNNING)).rowcount
+
+    def purge(self, retention):
+        '''
+        删除完成超过retention秒的任务
+        '''
+        before = time.time() - retention
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                self._db.execute('DELETE FROM items WHERE job_id IN (SELECT id FROM jobs WHERE finished < ?)',
+                                 (before,))
+                purged = self._db.execute('DELETE FROM jobs WHERE finished < ?', (before,)).rowcount
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return purged
+
+    def pending(self):
+        '''
+        :return: 尚未完成的条目数
+        '''
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM items WHERE status != ?', (DONE,)).fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            items = dict(self._db.execute('SELECT status, COUNT(*) FROM items GROUP BY status').fetchall())
+            jobs = dict(self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {'path': self.path,
+                'jobs': {status: jobs.get(status, 0) for status in (QUEUED, RUNNING, DONE)},
+                'items': {status: items.get(status, 0) for status in (QUEUED, RUNNING, DONE)},
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'retried': self.retried}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+    图片方向判定
+
+    sequential: 原有做法，按 0/180/270/90 依次做完整OCR，直到出现关键字
+    probe:      先检测一次文本框，根据框的几何形状确定是横排(0/180)还是竖排(90/270)，
+                再只识别几行最大的文本框来比较候选方向，最后只做一次完整OCR；
+                结果未通过校验时再退回sequential
+    speculative: 从session池里借出空闲的session，并行尝试四个方向，第一个通过校验的结果胜出，
+                其余方向在下一行识别前停止；没有空闲session时等价于sequential
+
+    是否通过校验由 validators 中按 doc_type 选出的校验器决定，校验器可以在识别到一半时提前拒绝，
+    此时立即放弃该方向
+
+    所有策略都复用检测结果：180度的图只是像素翻转，文本框可以由0度的检测结果几何变换得到，
+    所以每个轴(0/180、270/90)只检测一次，翻转的方向只重新识别
+
+    大图在缩小到 detect_size 的图上检测，文本框映射回原图坐标后，识别仍然使用原图裁剪；
+    缩小后仍超过 tiling.tile_size 时分块检测
+
+    cancel(threading.Event)被设置时（请求超过期限或客户端断开），在两个方向之间或两行识别之间
+    抛出 Cancelled，不再做没人要的识别
+'''
+
+import queue
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import numpy as np
+from backend.tr import tr
+from backend.tools import validators
+from backend.tools import preprocess
+from backend.tools import tiling
+
+ROTATIONS = [0, 180, 270, 90]
+STRATEGIES = ('sequential', 'probe', 'speculative')
+default_strategy = 'probe'
+PROBE_LINES = 5  # probe时参与识别的文本框数量
+detect_size = 1600  # 检测时图片的最长边，超过时先缩小；0表示在原图上检测
+
+
+def rotate(gray, rotation):
+    '''
+    逆时针旋转，与 PIL 的 img.rotate(rotation, expand=True) 一致
+    返回的是视图，不复制；送进 tr 时由 tr.c_img 复制一次
+    '''
+    return np.rot90(gray, rotation // 90)
+
+
+class Cancelled(Exception):
+    '''
+    请求已超过期限或客户端已断开
+    '''
+
+
+def check_cancelled(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+
+# 每个方向复用哪个方向的检测结果
+_AXIS = {0: 0, 180: 0, 270: 270, 90: 270}
+
+
+class Detections(dict):
+    '''
+    {轴方向: (该方向的原图, 原图坐标下的文本框)}，同一请求内共享，缺失时才检测
+    small 为缩小后用于检测的图，每个请求只缩小一次，各轴方向旋转它的视图
+    tiles 为分块检测的块数，不分块时为0
+    '''
+
+    def __init__(self, gray, max_size=None):
+        super().__init__()
+        self.small, self.scale = preprocess.downscale(gray, detect_size if max_size is None else max_size)
+        self.tiles = 0
+
+
+def detect(gray, base, detections, ctpn_id=0, lock=None):
+    '''
+    :param detections: Detections
+    :param lock: 并行尝试时，保证同一个轴只检测一次
+    '''
+    if lock is not None:
+        with lock:
+            return detect(gray, base, detections, ctpn_id)
+    if base not in detections:
+        small = rotate(detections.small, base)
+        if tiling.tile_size and max(small.shape) > tiling.tile_size:
+            rects, tiles = tiling.detect_tiled(small, ctpn_id)
+            detections.tiles += tiles
+        else:
+            rects = tr.detect(small, flag=tr.FLAG_ROTATED_RECT, ctpn_id=ctpn_id)
+        if detections.scale != 1.:
+            scale = detections.scale
+            rects = [[cx * scale, cy * scale, w * scale, h * scale, a] for cx, cy, w, h, a in rects]
+        detections[base] = (rotate(gray, base), rects)
+    return detections[base]
+
+
+def run(gray, rotation, detections, validator, ctpn_id=0, crnn_id=1, lock=None, stop=None, cancel=None):
+    '''
+    :return: (plain_text, valid)，校验器提前拒绝时plain_text只包含已识别的行
+    :raise Cancelled:
+    '''
+    base = _AXIS[rotation]
+    img, rects = detect(gray, base, detections, ctpn_id, lock)
+    verdict = []
+
+    def on_line(lines):
+        # 提前通过后不再校验，继续识别完本方向的剩余行
+        if not verdict:
+            result = validator.check(lines, len(rects))
+            if result is not None:
+                verdict.append(result)
+        return verdict == [validators.REJECT] or (cancel is not None and cancel.is_set())
+
+    check_cancelled(cancel)
+    res = tr.recognize_regions(img, rects, rotation=rotation - base, crnn_id=crnn_id, stop=stop, on_line=on_line)
+    check_cancelled(cancel)
+    if not verdict:
+        # 没有文本框时on_line不会被调用
+        verdict.append(validator.check([], 0))
+    return '|'.join([item[1] for item in res]), verdict[0] == validators.ACCEPT
+
+
+def search_sequential(gray, validator, rotations=ROTATIONS, detections=None, ctpn_id=0, crnn_id=1, cancel=None):
+    '''
+    :return: (plain_text, rotation, attempts, valid)
+    '''
+    detections = Detections(gray) if detections is None else detections
+    plain_text, rotation, attempts = '', 0, 0
+    for rotation in rotations:
+        plain_text, valid = run(gray, rotation, detections, validator, ctpn_id, crnn_id, cancel=cancel)
+        attempts += 1
+        if valid:
+            return plain_text, rotation, attempts, True
+    return plain_text, rotation, attempts, False
+
+
+def _rect_area(rect):
+    return rect[2] * rect[3]
+
+
+def _is_vertical(rect):
+    # 文本框投影到坐标轴后高大于宽，说明文字是竖排的
+    _, _, w, h, a = rect[:5]
+    theta = np.deg2rad(a)
+    width = abs(w * np.cos(theta)) + abs(h * np.sin(theta))
+    height = abs(w * np.sin(theta)) + abs(h * np.cos(theta))
+    return height > width
+
+
+def probe_rotation(gray, detections, validator, ctpn_id=0, crnn_id=1, probe_lines=PROBE_LINES):
+    '''
+    只检测一次，用最大的几个文本框判断方向；检测结果存入detections供后续复用
+    '''
+    _, rects = detect(gray, 0, detections, ctpn_id)
+    if not rects:
+        return 0
+
+    total_area = sum(_rect_area(rect) for rect in rects)
+    vertical_area = sum(_rect_area(rect) for rect in rects if _is_vertical(rect))
+    candidates = (90, 270) if vertical_area > total_area / 2 else (0, 180)
+
+    largest = sorted(rects, key=_rect_area, reverse=True)[:probe_lines]
+    crops = [tr.crop_rect(gray, rect) for rect in largest]
+
+    best_rotation, best_score = candidates[0], -1.
+    for rotation in candidates:
+        results = [tr.recognize(rotate(crop, rotation), crnn_id=crnn_id) for crop in crops]
+        # 只看了部分行，只有提前通过才算数
+        if validator.check(results, len(rects)) == validators.ACCEPT:
+            return rotation
+        # 方向错误时识别出的字更少、置信度更低
+        score = sum(confidence for txt, confidence in results if txt) / len(results)
+        if score > best_score:
+            best_rotation, best_score = rotation, score
+    return best_rotation
+
+
+_speculative_executor = None
+_speculative_executor_lock = threading.Lock()
+
+
+def _get_speculative_executor():
+    # 同时运行的尝试不会超过session数量，线程数与之一致即可
+    global _speculative_executor
+    with _speculative_executor_lock:
+        if _speculative_executor is None or _speculative_executor._max_workers < tr.session_count():
+            _speculative_executor = ThreadPoolExecutor(max_workers=tr.session_count(),
+                                                       thread_name_prefix='orientation')
+        return _speculative_executor
+
+
+def search_speculative(gray, validator, ctpn_id=0, crnn_id=1, detections=None, cancel=None):
+    '''
+    除调用方自己的session外，再借用当前空闲的session，每个session一条通道，按轮转分配四个方向
+    :return: (plain_text, rotation, attempts, valid, lanes)
+    '''
+    sessions = [(ctpn_id, crnn_id)]
+    while len(sessions) < len(ROTATIONS):
+        try:
+            sessions.append(tr.acquire_session(timeout=0))
+        except queue.Empty:
+            break
+
+    lanes = [ROTATIONS[i::len(sessions)] for i in range(len(sessions))]
+    detections = Detections(gray) if detections is None else detections
+    locks = {base: threading.Lock() for base in set(_AXIS.values())}
+    stop = threading.Event()
+    results = {}
+
+    def run_lane(rotations, lane_ctpn_id, lane_crnn_id):
+        for rotation in rotations:
+            if stop.is_set():
+                return
+            try:
+                plain_text, valid = run(gray, rotation, detections, validator, lane_ctpn_id, lane_crnn_id,
+                                        locks[_AXIS[rotation]], stop, cancel)
+            except Cancelled:
+                stop.set()
+                return
+            if stop.is_set():
+                # 已有其他方向胜出，被打断的结果不完整
+                return
+            results[rotation] = plain_text
+            if valid:
+                stop.set()
+                return rotation
+
+    executor = _get_speculative_executor()
+    # 每个通道在调用方上下文的副本里运行，tr.track_copies 的统计才能覆盖到
+    futures = [executor.submit(contextvars.copy_context().run, run_lane, rotations, *ids)
+               for rotations, ids in zip(lanes, sessions)]
+    try:
+        winner = None
+        for future in as_completed(futures):
+            winner = future.result()
+            if winner is not None:
+                break
+    finally:
+        stop.set()
+        # 等所有通道退出后才能把session还回去
+        wait(futures)
+        for ids in sessions[1:]:
+            tr.release_session(ids)
+
+    check_cancelled(cancel)
+    if winner is not None:
+        return results[winner], winner, len(results), True, len(sessions)
+    rotation = ROTATIONS[-1]
+    return results.get(rotation, ''), rotation, len(results), False, len(sessions)
+
+
+def search(gray, strategy=None, ctpn_id=0, crnn_id=1, validator=None, cancel=None):
+    '''
+    :param gray: 横向放置的灰度图
+    :param validator: 校验器，默认使用 validators.default_doc_type 对应的校验器
+    :param cancel: threading.Event，被设置后尽快抛出 Cancelled
+    :return: (plain_text, rotation, info)，info记录使用的策略、识别次数、检测次数、检测缩放比例和是否通过校验
+    '''
+    strategy = strategy or default_strategy
+    validator = validator or validators.get()
+    detections = Detections(gray)
+    if strategy == 'probe':
+        rotation = probe_rotation(gray, detections, validator, ctpn_id, crnn_id)
+        plain_text, valid = run(gray, rotation, detections, validator, ctpn_id, crnn_id, cancel=cancel)
+        if valid:
+            info = {'strategy': 'probe', 'attempts': 1, 'detections': len(detections), 'valid': True}
+        else:
+            rest = [r for r in ROTATIONS if r != rotation]
+            plain_text, rotation, attempts, valid = search_sequential(
+                gray, validator, rest, detections, ctpn_id, crnn_id, cancel)
+            info = {'strategy': 'probe_fallback', 'attempts': attempts + 1, 'detections': len(detections),
+                    'valid': valid}
+    elif strategy == 'speculative':
+        plain_text, rotation, attempts, valid, lanes = search_speculative(gray, validator, ctpn_id, crnn_id,
+                                                                          detections, cancel)
+        info = {'strategy': 'speculative', 'attempts': attempts, 'lanes': lanes, 'valid': valid}
+    else:
+        plain_text, rotation, attempts, valid = search_sequential(
+            gray, validator, ROTATIONS, detections, ctpn_id, crnn_id, cancel)
+        info = {'strategy': 'sequential', 'attempts': attempts, 'detections': len(detections), 'valid': valid}
+
+    info['detect_scale'] = round(1. / detections.scale, 4)
+    info['tiles'] = detections.tiles
+    return plain_text, rotation, info
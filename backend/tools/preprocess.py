@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+    图片预处理：只解码一次，直接得到8位灰度、C连续的ndarray
+
+    JPEG 通过 Image.draft 让 libjpeg 直接输出灰度，省掉RGB转换；需要压缩时还能在DCT域按
+    1/2、1/4、1/8 缩小解码，大图的解码时间和内存都随之下降。其他格式解码后转一次L
+    之后的旋转都是 np.rot90 视图，只有送进 tr 时才由 tr.c_img 复制一次成连续内存
+'''
+
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# 解码后图片的最长边，超过时缩小；0表示不压缩。请求的compress参数可以覆盖
+default_max_size = 0
+
+
+def _fit(width, height, max_size):
+    scale = max(width, height) / max_size
+    return max(int(width / scale + 0.5), 1), max(int(height / scale + 0.5), 1)
+
+
+def decode_gray(data, max_size=None):
+    '''
+    :param data: 图片文件的字节
+    :param max_size: 最长边上限，None使用default_max_size，小于1表示不压缩
+    :return: (gray, stats)，gray 为 (h, w) uint8 数组，stats 记录原图尺寸、解码耗时和分配的字节数
+    '''
+    start_time = time.time()
+    max_size = default_max_size if max_size is None else max_size
+    img = Image.open(BytesIO(data))
+    width, height = img.size
+    target = _fit(width, height, max_size) if 0 < max_size < max(width, height) else (width, height)
+
+    if img.format == 'JPEG':
+        # draft 选择不小于target的最小DCT缩放比例，并直接解码成灰度
+        img.draft('L', target)
+    if img.mode != 'L':
+        img = img.convert('L')
+    if img.size != target:
+        img = img.resize(target, Image.LANCZOS)
+    gray = np.asarray(img)
+    img.close()
+
+    stats = {'decode_time': round(time.time() - start_time, 3),
+             'original_size': [width, height],
+             'width': gray.shape[1],
+             'height': gray.shape[0],
+             'decode_bytes': gray.nbytes}
+    return gray, stats
+
+
+def downscale(gray, max_size):
+    '''
+    把最长边缩小到max_size，用于在小图上检测
+    :return: (small, scale)，原图坐标 = 小图坐标 * scale；不需要缩小时返回 (gray, 1.)
+    '''
+    height, width = gray.shape[:2]
+    if max_size < 1 or max(width, height) <= max_size:
+        return gray, 1.
+    size = _fit(width, height, max_size)
+    small = np.asarray(Image.fromarray(gray).resize(size, Image.BILINEAR, reducing_gap=2.))
+    return small, width / size[0]
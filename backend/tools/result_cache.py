@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+    网关的识别结果缓存：以图片字节和OCR参数的哈希为键，存放在本地SQLite文件中，
+    网关或子进程重启后依然有效，多个网关进程也可以共用同一个文件
+
+    淘汰策略：超过ttl的条目视为失效；条目数或总字节数超过上限时按最近访问时间淘汰(LRU)
+'''
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def make_key(fields):
+    '''
+    :param fields: [(name, bytes)]，图片内容和影响识别结果的参数，调用方负责排序
+    :return: 十六进制sha256
+    '''
+    digest = hashlib.sha256()
+    for name, value in fields:
+        # 带上长度，避免不同的字段切分得到同样的字节流
+        digest.update(f'{name}:{len(value)}:'.encode())
+        digest.update(value)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    '''
+    SQLite是同步接口，网关应在线程池中调用 get/put
+    '''
+
+    def __init__(self, path, max_entries=10000, max_bytes=512 * 1024 * 1024, ttl=24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WAL下读写互不阻塞，也允许多个进程共用
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS results (
+                                key TEXT PRIMARY KEY,
+                                content BLOB NOT NULL,
+                                content_type TEXT,
+                                size INTEGER NOT NULL,
+                                created REAL NOT NULL,
+                                accessed REAL NOT NULL)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+
+    def get(self, key):
+        '''
+        :return: (content, content_type)，未命中或已过期时返回None
+        '''
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT content, content_type, created FROM results WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is not None and self.ttl and row[2] < now - self.ttl:
+                self._db.execute('DELETE FROM results WHERE key = ?', (key,))
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return row[0], row[1]
+
+    def put(self, key, content, content_type=None):
+        if self.max_bytes and len(content) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO results (key, content, content_type, size, created, accessed) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (key, content, content_type, len(content), now, now))
+            self.stores += 1
+            self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl:
+            self.evictions += self._db.execute('DELETE FROM results WHERE created < ?', (now - self.ttl,)).rowcount
+        count, total = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        if not ((self.max_entries and count > self.max_entries) or (self.max_bytes and total > self.max_bytes)):
+            return
+        # 按最近访问时间从旧到新淘汰，直到两个上限都满足
+        evicted = []
+        for key, size in self._db.execute('SELECT key, size FROM results ORDER BY accessed').fetchall():
+            if not ((self.max_entries and count > self.max_entries) or (self.max_bytes and total > self.max_bytes)):
+                break
+            evicted.append((key,))
+            count -= 1
+            total -= size
+        self._db.executemany('DELETE FROM results WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM results')
+
+    def stats(self):
+        with self._lock:
+            count, total = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        lookups = self.hits + self.misses
+        return {'path': self.path,
+                'entries': count,
+                'bytes': total,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypasses': self.bypasses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -2,12 +2,14 @@
 import os
 import platform
 import ctypes
+import queue
+import atexit
+import threading
+import contextlib
+import contextvars
 import numpy as np
 
-try:
-    unichr
-except NameError:
-    unichr = chr
+from .ctc import parse as _parse, parse_batch
 
 CV_8UC1 = 0
 CV_32FC1 = 5
@@ -88,16 +90,68 @@ def c_ptr(arr):
 
     if isinstance(arr, np.ndarray):
         assert arr.flags['C_CONTIGUOUS']
-        return np.ctypeslib.as_ctypes(arr)
+        # unlike np.ctypeslib.as_ctypes this also accepts read-only arrays, e.g.
+        # np.asarray(PIL.Image); older numpy does not tie `arr` to the pointer,
+        # so keep the reference here or a temporary copy is freed too early
+        ptr = arr.ctypes.data_as(ctypes.c_void_p)
+        ptr._arr = arr
+        return ptr
     elif isinstance(arr, str):
         return ctypes.create_string_buffer(arr.encode())
     else:
         raise NotImplementedError()
 
 
+class CopyStats(object):
+    """
+    Bytes copied by `c_img` to get C-contiguous input, see `track_copies`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.copies = 0
+        self.bytes = 0
+
+    def add(self, arr):
+        with self._lock:
+            self.copies += 1
+            self.bytes += arr.nbytes
+
+
+_copy_stats = contextvars.ContextVar("copy_stats", default=None)
+
+
+@contextlib.contextmanager
+def track_copies(stats=None):
+    """
+    Count the copies `c_img` makes in this context (and in contexts copied from it,
+    e.g. with contextvars.copy_context() for helper threads).
+    :return: CopyStats
+    """
+    stats = CopyStats() if stats is None else stats
+    token = _copy_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _copy_stats.reset(token)
+
+
+def _copied(arr):
+    stats = _copy_stats.get()
+    if stats is not None:
+        stats.add(arr)
+    return arr
+
+
 def c_img(arr):
+    """
+    Accepts any 2-D/3-D uint8 or float32 array, including np.rot90 views and other
+    non-contiguous ones, which are copied once here.
+    """
     if not isinstance(arr, (np.ndarray, str)):
-        arr = np.array(arr)
+        arr = _copied(np.asarray(arr))
+    elif isinstance(arr, np.ndarray) and not arr.flags['C_CONTIGUOUS']:
+        arr = _copied(np.ascontiguousarray(arr))
 
     if isinstance(arr, str):
         return c_ptr(arr), 0, 0, 0
@@ -142,28 +196,95 @@ def init(pid, id, model, arg=None):
     os.chdir(_cwd)
 
 
-def _parse(unicode_arr, prob_arr, num):
-    txt = ""
-    prob = 0.
-    unicode_pre = -1
-    count = 0
-    for pos in range(num):
-        unicode = unicode_arr[pos]
-        if unicode >= 0:
-            if unicode != unicode_pre:
-                txt += unichr(unicode)
+_session_lock = threading.Lock()
+_sessions = []
+_free_sessions = queue.Queue()
 
-            count += 1
-            prob += prob_arr[pos]
 
-        unicode_pre = unicode
+def init_sessions(num, pid=0):
+    """
+    Make sure at least `num` (ctpn_id, crnn_id) session pairs are initialised.
+    Pair i uses ids (2 * i, 2 * i + 1), so the first pair is the default (0, 1).
+    :param num: number of session pairs
+    :param pid: process id passed to tr_init
+    :return: number of initialised pairs
+    """
+    with _session_lock:
+        while len(_sessions) < num:
+            ctpn_id = 2 * len(_sessions)
+            crnn_id = ctpn_id + 1
+            init(pid, ctpn_id, "ctpn.bin")
+            init(pid, crnn_id, "crnn.bin")
+            _sessions.append((ctpn_id, crnn_id))
+            _free_sessions.put((ctpn_id, crnn_id))
+        return len(_sessions)
 
-    return txt, float(prob / max(count, 1))
+
+def sessions():
+    return list(_sessions)
+
+
+def session_count():
+    return len(_sessions)
+
+
+def acquire_session(timeout=None):
+    """
+    Check out a (ctpn_id, crnn_id) pair, blocking until one is free.
+    :raise queue.Empty: if `timeout` expires
+    """
+    return _free_sessions.get(timeout=timeout)
+
+
+def release_session(ids):
+    _free_sessions.put(ids)
+
+
+@contextlib.contextmanager
+def session(timeout=None):
+    ids = acquire_session(timeout)
+    try:
+        yield ids
+    finally:
+        release_session(ids)
+
+
+def release_sessions():
+    with _session_lock:
+        for ctpn_id, crnn_id in _sessions:
+            release(ctpn_id, crnn_id)
+        del _sessions[:]
+        while True:
+            try:
+                _free_sessions.get_nowait()
+            except queue.Empty:
+                break
+
+
+_arena = threading.local()
+
+
+def _buffer(name, shape, dtype):
+    """
+    Return a C-contiguous array of `shape` backed by a per-thread buffer that is
+    reused across calls and only reallocated when a larger one is needed.
+    The contents are NOT zeroed, so callers must only read what tr_* wrote.
+    """
+    buffers = getattr(_arena, "buffers", None)
+    if buffers is None:
+        buffers = _arena.buffers = {}
+
+    size = int(np.prod(shape))
+    buf = buffers.get(name)
+    if buf is None or buf.size < size:
+        buf = np.empty((size,), dtype=dtype)
+        buffers[name] = buf
+    return buf[:size].reshape(shape)
 
 
 def crnn(img, max_items=512*7000, crnn_id=1):
-    buf_arr = np.zeros((max_items,), dtype="float32")
-    shape_arr = np.zeros((8,), dtype="int32")
+    buf_arr = _buffer("crnn", (max_items,), "float32")
+    shape_arr = _buffer("crnn_shape", (8,), "int32")
     img = c_img(img)
 
     assert img[3] == CV_32FC1
@@ -178,12 +299,13 @@ def crnn(img, max_items=512*7000, crnn_id=1):
     )
 
     buf_arr = buf_arr[:num]
-    return buf_arr.reshape(shape_arr[0], shape_arr[2])
+    # the buffer is reused by the next call
+    return buf_arr.reshape(shape_arr[0], shape_arr[2]).copy()
 
 
 def recognize(img, max_width=512, crnn_id=1):
-    unicode_arr = np.zeros((max_width,), dtype="int32")
-    prob_arr = np.zeros((max_width,), dtype="float32")
+    unicode_arr = _buffer("unicode", (max_width,), "int32")
+    prob_arr = _buffer("prob", (max_width,), "float32")
     img = c_img(img)
     num = _libc.tr_recognize(
         crnn_id,
@@ -196,20 +318,189 @@ def recognize(img, max_width=512, crnn_id=1):
     return _parse(unicode_arr, prob_arr, num)
 
 
+def _resize_height(img, out):
+    """
+    Bilinear resize of a 2-D uint8 `img` into the preallocated (height, width) `out`.
+    """
+    h, w = img.shape[:2]
+    height, width = out.shape
+    if (h, w) == (height, width):
+        out[...] = img
+        return out
+    ys = np.clip((np.arange(height, dtype=np.float32) + 0.5) * (h / float(height)) - 0.5, 0, h - 1)
+    xs = np.clip((np.arange(width, dtype=np.float32) + 0.5) * (w / float(width)) - 0.5, 0, w - 1)
+    y0 = ys.astype(np.intp)
+    x0 = xs.astype(np.intp)
+    y1 = np.minimum(y0 + 1, h - 1)
+    x1 = np.minimum(x0 + 1, w - 1)
+    fy = (ys - y0)[:, None]
+    fx = xs - x0
+    rows = img[y0] * (1 - fy) + img[y1] * fy
+    out[...] = rows[:, x0] * (1 - fx) + rows[:, x1] * fx + 0.5
+    return out
+
+
+def recognize_batch(crops, max_width=512, crnn_id=1):
+    """
+    Recognize many single-line crops, e.g. from a custom detector, on one session.
+    Every crop is resized to the CRNN input height (32) into one reused per-thread
+    pixel block, so tr_recognize gets contiguous input without per-crop copies or
+    allocations. libtr has no batched CRNN entry point, so the crops run as a tight
+    tr_recognize loop writing into one (len(crops), max_width) output, and all of it
+    is decoded with a single `parse_batch`.
+    :param crops: 2-D uint8 arrays of any size; views such as np.rot90 are fine
+    :return: [(txt, confidence)] in the order of `crops`
+    """
+    crops = [np.asarray(crop) for crop in crops]
+    if not crops:
+        return []
+
+    height = 32
+    widths = []
+    for crop in crops:
+        if crop.ndim != 2 or crop.dtype != np.uint8:
+            raise NotImplementedError()
+        h, w = crop.shape
+        widths.append(max(int(round(w * height / float(h))), 1) if h and w else 0)
+    offsets = np.cumsum([0] + [height * width for width in widths]).tolist()
+
+    pixels = _buffer("batch_pixels", (max(offsets[-1], 1),), "uint8")
+    unicode_arr = _buffer("batch_unicode", (len(crops), max_width), "int32")
+    prob_arr = _buffer("batch_prob", (len(crops), max_width), "float32")
+    nums = np.zeros((len(crops),), dtype=np.int64)
+
+    # raw addresses of the rows, the arrays above stay referenced for the whole loop
+    pixels_addr = pixels.ctypes.data
+    unicode_addr = unicode_arr.ctypes.data
+    prob_addr = prob_arr.ctypes.data
+    unicode_step = unicode_arr.strides[0]
+    prob_step = prob_arr.strides[0]
+    for i, (crop, width) in enumerate(zip(crops, widths)):
+        if not width:
+            continue
+        _resize_height(crop, pixels[offsets[i]:offsets[i + 1]].reshape(height, width))
+        nums[i] = _libc.tr_recognize(
+            crnn_id,
+            pixels_addr + offsets[i], height, width, CV_8UC1,
+            unicode_addr + i * unicode_step,
+            prob_addr + i * prob_step,
+            max_width
+        )
+
+    return parse_batch(unicode_arr, prob_arr, nums)
+
+
 def detect(img, max_lines=512, flag=FLAG_ROTATED_RECT, ctpn_id=0):
-    rect_arr = np.zeros((max_lines, RECT_SIZE), dtype="float32")
+    """
+    :param max_lines: initial capacity; doubled and retried while the result fills it
+    """
     img = c_img(img)
-    num = _libc.tr_detect(
-        ctpn_id,
-        img[0], img[1], img[2], img[3],
-        flag,
-        c_ptr(rect_arr),
-        max_lines
-    )
+    while True:
+        rect_arr = _buffer("rect", (max_lines, RECT_SIZE), "float32")
+        num = _libc.tr_detect(
+            ctpn_id,
+            img[0], img[1], img[2], img[3],
+            flag,
+            c_ptr(rect_arr),
+            max_lines
+        )
+        if num < max_lines:
+            break
+        max_lines *= 2
 
     return rect_arr[:num, :5].tolist()
 
 
+def crop_rect(img, rect):
+    """
+    Cut a rect returned by `detect` out of a grayscale image, upright.
+    :param img: 2-D uint8 array
+    :param rect: (cx, cy, w, h, angle), angle in degrees as used by cv2.boxPoints
+    :return: (h, w) uint8 array
+    """
+    cx, cy, w, h, a = rect[:5]
+    w = max(int(round(w)), 1)
+    h = max(int(round(h)), 1)
+    img_h, img_w = img.shape[:2]
+
+    if abs(a) < 1e-3:
+        x0 = int(round(cx - w / 2.))
+        y0 = int(round(cy - h / 2.))
+        return np.ascontiguousarray(img[max(y0, 0):min(y0 + h, img_h), max(x0, 0):min(x0 + w, img_w)])
+
+    # bilinear sampling along the rotated axes of the rect
+    theta = np.deg2rad(a)
+    u = np.arange(w, dtype=np.float32) - (w - 1) / 2.
+    v = np.arange(h, dtype=np.float32) - (h - 1) / 2.
+    xs = cx + u[None, :] * np.cos(theta) - v[:, None] * np.sin(theta)
+    ys = cy + u[None, :] * np.sin(theta) + v[:, None] * np.cos(theta)
+    xs = np.clip(xs, 0, img_w - 1)
+    ys = np.clip(ys, 0, img_h - 1)
+    x0 = np.floor(xs).astype(np.intp)
+    y0 = np.floor(ys).astype(np.intp)
+    x1 = np.minimum(x0 + 1, img_w - 1)
+    y1 = np.minimum(y0 + 1, img_h - 1)
+    fx = xs - x0
+    fy = ys - y0
+    out = (img[y0, x0] * (1 - fx) * (1 - fy) + img[y0, x1] * fx * (1 - fy) +
+           img[y1, x0] * (1 - fx) * fy + img[y1, x1] * fx * fy)
+    return (out + 0.5).astype(np.uint8)
+
+
+def rotate_rects(rects, rotation, width, height):
+    """
+    Map rects detected on a (height, width) image into the coordinates of the
+    same image rotated counter-clockwise by `rotation` (a multiple of 90),
+    i.e. np.rot90(img, rotation // 90).
+    """
+    rotation %= 360
+    res = []
+    for cx, cy, w, h, a in (rect[:5] for rect in rects):
+        if rotation == 90:
+            res.append([cy, width - cx, h, w, a])
+        elif rotation == 180:
+            res.append([width - cx, height - cy, w, h, a])
+        elif rotation == 270:
+            res.append([height - cy, cx, h, w, a])
+        else:
+            res.append([cx, cy, w, h, a])
+    return res
+
+
+def recognize_regions(img, rects, rotation=0, max_width=512, crnn_id=1, stop=None, on_line=None):
+    """
+    Recognize every rect returned by `detect(img)`.
+    :param rotation: counter-clockwise rotation applied to each crop first, so rects
+        detected on `img` are read as if they had been detected on the rotated image
+    :param stop: optional threading.Event; when set, the remaining rects are skipped
+    :param on_line: optional callback called with the [(txt, confidence)] recognized
+        so far after each rect; returning True skips the remaining rects
+    :return: [(rect, txt, confidence)] like `run`, rects and line order in the
+        coordinates of the rotated image
+    """
+    rotation %= 360
+    results = []
+    for rect in rects:
+        if stop is not None and stop.is_set():
+            rects = rects[:len(results)]
+            break
+        crop = crop_rect(img, rect)
+        if rotation:
+            crop = np.rot90(crop, rotation // 90)
+        txt, confidence = recognize(crop, max_width=max_width, crnn_id=crnn_id)
+        results.append((txt, confidence))
+        if on_line is not None and on_line(results) and len(results) < len(rects):
+            rects = rects[:len(results)]
+            break
+
+    rects = rotate_rects(rects, rotation, img.shape[1], img.shape[0])
+    results = [(rect, txt, confidence) for rect, (txt, confidence) in zip(rects, results)]
+    if rotation == 180:
+        # detect returns lines top to bottom, which is bottom to top once flipped
+        results.reverse()
+    return results
+
+
 def release(*args):
     for arg in args:
         _libc.tr_release(arg)
@@ -221,32 +512,37 @@ def run(img,
         max_width=512,
         ctpn_id=0,
         crnn_id=1):
-    rect_arr = np.zeros((max_lines, RECT_SIZE), dtype="float32")
-    unicode_arr = np.zeros((max_lines, max_width), dtype="int32")
-    prob_arr = np.zeros((max_lines, max_width), dtype="float32")
+    """
+    :param max_lines: initial capacity; doubled and retried while the result fills it
+    """
     img = c_img(img)
-    line_num = _libc.tr_run(
-        ctpn_id, crnn_id,
-        img[0], img[1], img[2], img[3],
-        flag,
-        c_ptr(rect_arr),
-        max_lines,
-        c_ptr(unicode_arr),
-        c_ptr(prob_arr),
-        max_width
-    )
-
-    results = []
-    for i in range(line_num):
-        num = int(rect_arr[i][-1] + 0.5)
-        txt, confidence = _parse(unicode_arr[i], prob_arr[i], num)
-        results.append((rect_arr[i][:5].tolist(), txt, confidence))
-
-    return results
-
-
-init(0, 0, "ctpn.bin")
-init(0, 1, "crnn.bin")
+    while True:
+        rect_arr = _buffer("rect", (max_lines, RECT_SIZE), "float32")
+        unicode_arr = _buffer("unicode", (max_lines, max_width), "int32")
+        prob_arr = _buffer("prob", (max_lines, max_width), "float32")
+        line_num = _libc.tr_run(
+            ctpn_id, crnn_id,
+            img[0], img[1], img[2], img[3],
+            flag,
+            c_ptr(rect_arr),
+            max_lines,
+            c_ptr(unicode_arr),
+            c_ptr(prob_arr),
+            max_width
+        )
+        if line_num < max_lines:
+            break
+        max_lines *= 2
+
+    nums = (rect_arr[:line_num, -1] + 0.5).astype(np.int64)
+    texts = parse_batch(unicode_arr[:line_num], prob_arr[:line_num], nums)
+    rects = rect_arr[:line_num, :5].tolist()
+
+    return [(rect, txt, confidence) for rect, (txt, confidence) in zip(rects, texts)]
+
+
+init_sessions(1)
+atexit.register(release_sessions)
 
 if __name__ == "__main__":
     pass
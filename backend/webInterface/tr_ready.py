@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+import json
+import numpy as np
+import tornado.web
+from backend.tr import tr
+
+from backend.tools.np_encoder import NpEncoder
+from backend.tools import log
+import logging
+
+logger = logging.getLogger(log.LOGGER_ROOT_NAME + '.' + __name__)
+
+# 只有完成一次预热推理后才对外报告ready
+state = {'ready': False, 'warmup_time': None, 'sessions': 0}
+
+
+def warmup():
+    '''
+    对每组session分别跑一次检测和识别，确保 ctpn.bin / crnn.bin 已加载且首次推理的开销已付清
+    '''
+    start_time = time.time()
+    for ctpn_id, crnn_id in tr.sessions():
+        tr.detect(np.zeros((64, 256), dtype=np.uint8), flag=tr.FLAG_ROTATED_RECT, ctpn_id=ctpn_id)
+        tr.recognize(np.zeros((32, 128), dtype=np.uint8), crnn_id=crnn_id)
+    state['warmup_time'] = round(time.time() - start_time, 2)
+    state['sessions'] = tr.session_count()
+    state['ready'] = True
+    logger.info(json.dumps({'msg': 'warmup done', 'warmup_time': state['warmup_time']}, cls=NpEncoder))
+
+
+class TrReady(tornado.web.RequestHandler):
+    '''
+    就绪探针：预热完成前返回503
+    '''
+
+    def get(self):
+        self.set_header('content-type', 'application/json')
+        if not state['ready']:
+            self.set_status(503)
+            self.finish(json.dumps({'code': 503, 'msg': 'warming up'}, cls=NpEncoder))
+            return
+        self.finish(json.dumps({'code': 200, 'msg': 'ready', 'data': state}, cls=NpEncoder))
@@ -3,6 +3,7 @@
 # author:alisen
 # time: 2020/4/29 10:47
 
+import math
 import time
 import cv2
 import numpy as np
@@ -10,18 +11,110 @@ from backend.tr import tr
 import tornado.web
 import tornado.gen
 import tornado.httpserver
+import tornado.ioloop
+import tornado.iostream
 import base64
-from PIL import Image, ImageDraw
-from io import BytesIO
 import datetime
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from backend.tools.np_encoder import NpEncoder
 from backend.tools import log
+from backend.tools import batch
+from backend.tools import orientation
+from backend.tools import preprocess
+from backend.tools import validators
 import logging
 
 logger = logging.getLogger(log.LOGGER_ROOT_NAME + '.' + __name__)
 
+# OCR放到线程池里执行，tr_run通过ctypes调用时会释放GIL，IOLoop可以继续接收上传、响应探针
+# 线程数与可用的native session数量一致，每个线程执行时从tr的session池里借一组 (ctpn_id, crnn_id)
+ocr_executor = ThreadPoolExecutor(max_workers=tr.session_count(), thread_name_prefix='ocr')
+
+# 请求的剩余期限（秒），由网关转发时填写；超过期限或客户端断开后不再继续识别
+TIMEOUT_HEADER = 'X-Request-Timeout'
+
+
+def parse_timeout(value):
+    '''
+    :return: 请求头中的剩余秒数，没有该请求头时返回None
+    :raise ValueError: 不是有限的数
+    '''
+    if value is None:
+        return None
+    timeout = float(value)
+    if not math.isfinite(timeout):
+        raise ValueError(value)
+    return timeout
+
+
+def init_ocr_workers(num):
+    '''
+    初始化num组native session，并把线程池调整为同样的大小
+    '''
+    global ocr_executor
+    num = tr.init_sessions(num)
+    if ocr_executor._max_workers != num:
+        ocr_executor.shutdown(wait=False)
+        ocr_executor = ThreadPoolExecutor(max_workers=num, thread_name_prefix='ocr')
+    return num
+
+
+def ocr(data, strategy=None, doc_type=None, max_size=None, cancel=None):
+    '''
+    解码、判定方向并识别图片，返回 (plain_text, rotation, orientation_info, preprocess_info)
+    :param data: 图片文件的字节
+    :param doc_type: 选择校验识别结果的校验器，见 validators.VALIDATORS
+    :param max_size: 解码后图片的最长边，见 preprocess.decode_gray
+    :param cancel: threading.Event，被设置后抛出 orientation.Cancelled
+    '''
+    # 在线程池里排队期间可能已经被取消
+    orientation.check_cancelled(cancel)
+    gray, stats = preprocess.decode_gray(data, max_size)
+    # 竖图先转成横图
+    if gray.shape[1] < gray.shape[0]:
+        gray = orientation.rotate(gray, 90)
+
+    # 进行ocr
+    with tr.session() as (ctpn_id, crnn_id), tr.track_copies() as copies:
+        plain_text, rotation, info = orientation.search(gray, strategy, ctpn_id, crnn_id,
+                                                        validators.get(doc_type), cancel)
+    info['doc_type'] = doc_type or validators.default_doc_type
+    # 解码之外，送进 tr 之前为得到连续内存而复制的次数和字节数
+    stats['copies'] = copies.copies
+    stats['copy_bytes'] = copies.bytes
+    stats['allocated_bytes'] = stats['decode_bytes'] + copies.bytes
+
+    if not info['valid']:
+        plain_text += '-----------问题数据-----------'
+
+    return plain_text, rotation, info, stats
+
+
+def ocr_batch_item(index, name, data, strategy, doc_type, max_size, cancel, batch_start):
+    '''
+    批量识别中的一张图片，出错只影响这一张
+    :return: 一行NDJSON结果
+    '''
+    start_time = time.time()
+    try:
+        plain_text, rotation, info, stats = ocr(data, strategy, doc_type, max_size, cancel)
+    except orientation.Cancelled:
+        status, result = 504, {'code': 504, 'msg': '请求超过期限或已断开，识别已取消'}
+    except Exception as ex:
+        logger.error(f'批量识别 {name} 失败', exc_info=True)
+        status, result = 500, {'code': 500, 'msg': '产生了一点错误，请检查日志', 'err': str(ex)}
+    else:
+        status = 200
+        result = {'code': 200, 'msg': '成功',
+                  'data': {'raw_out': plain_text + '------' + str(rotation),
+                           'orientation': dict(info, rotation=rotation),
+                           'preprocess': stats,
+                           'speed_time': round(time.time() - start_time, 2)}}
+    return batch.result_line(index, name, status, result, time.time() - batch_start, cls=NpEncoder)
+
 
 class TrRun(tornado.web.RequestHandler):
     '''
@@ -32,6 +125,12 @@ class TrRun(tornado.web.RequestHandler):
         self.set_status(404)
         self.write("404 : Please use POST")
 
+    def on_connection_close(self):
+        # 客户端（网关）断开后，OCR线程在下一个检查点停止
+        cancel = getattr(self, 'cancel', None)
+        if cancel is not None:
+            cancel.set()
+
     @tornado.gen.coroutine
     def post(self):
         '''
@@ -42,12 +141,13 @@ class TrRun(tornado.web.RequestHandler):
 
         '''
         start_time = time.time()
-        MAX_SIZE = 1600
 
         img_up = self.request.files.get('file', None)
         img_b64 = self.get_argument('img', None)
         compress_size = self.get_argument('compress', None)
         is_draw = self.get_argument("is_draw", None)
+        strategy = self.get_argument("orientation", None)
+        doc_type = self.get_argument("doc_type", None)
 
         # 判断是上传的图片还是base64
         self.set_header('content-type', 'application/json')
@@ -56,16 +156,26 @@ class TrRun(tornado.web.RequestHandler):
             img_up = img_up[0]
             up_image_type = img_up.content_type
             up_image_name = img_up.filename
-            img = Image.open(BytesIO(img_up.body))
+            data = img_up.body
         elif img_b64 is not None:
-            raw_image = base64.b64decode(img_b64.encode('utf8'))
-            img = Image.open(BytesIO(raw_image))
+            data = base64.b64decode(img_b64.encode('utf8'))
         else:
             self.set_status(400)
             logger.error(json.dumps({'code': 400, 'msg': '没有传入参数'}, cls=NpEncoder))
             self.finish(json.dumps({'code': 400, 'msg': '没有传入参数'}, cls=NpEncoder))
             return
 
+        if strategy is not None and strategy not in orientation.STRATEGIES:
+            self.set_status(400)
+            self.finish(json.dumps({'code': 400, 'msg': f'orientation参数只能是{"/".join(orientation.STRATEGIES)}'},
+                                   cls=NpEncoder))
+            return
+        if doc_type is not None and doc_type not in validators.VALIDATORS:
+            self.set_status(400)
+            self.finish(json.dumps({'code': 400, 'msg': f'doc_type参数只能是{"/".join(validators.VALIDATORS)}'},
+                                   cls=NpEncoder))
+            return
+
         # 旋转图片
         # try:
         #     if hasattr(img, '_getexif') and img._getexif() is not None:
@@ -83,61 +193,51 @@ class TrRun(tornado.web.RequestHandler):
         #     logger.error(error_log, exc_info=True)
         #     self.finish(error_log)
         #     return
-        # 获取图像的宽度和高度
-        img_width, img_height = img.size
-        # 打印图像的尺寸
-        if img_width < img_height:
-            img = img.rotate(90, expand=True)
-            
-        img = img.convert("RGB")
-        original_img = img
-#         '''
-#         是否开启图片压缩
-#         默认为1600px
-#         值为 0 时表示不开启压缩
-#         非 0 时则压缩到该值的大小
-#         '''
-#         if compress_size is not None:
-#             try:
-#                 compress_size = int(compress_size)
-#             except ValueError as ex:
-#                 logger.error(exc_info=True)
-#                 self.finish(json.dumps({'code': 400, 'msg': 'compress参数类型有误，只能是int类型'}, cls=NpEncoder))
-#                 return
-
-#             if compress_size < 1:
-#                 MAX_SIZE = max(img.height, img.width)
-#             else:
-#                 MAX_SIZE = compress_size
-
-#         if img.height > MAX_SIZE or img.width > MAX_SIZE:
-#             scale = max(img.height / MAX_SIZE, img.width / MAX_SIZE)
-#             new_width = int(img.width / scale + 0.5)
-#             new_height = int(img.height / scale + 0.5)
-#             img = img.resize((new_width, new_height), Image.ANTIALIAS)
-
-        # 进行ocr
-        direction_is_right = False
-        # res = tr.run(img.copy().convert("L"), flag=tr.FLAG_ROTATED_RECT)
-        # plain_text = '|'.join([item[1] for item in res])
-        for rotation in [0, 180, 270, 90]:
-            if rotation != 0:
-                img = original_img.copy().rotate(rotation, expand=True)
-            res = tr.run(img.copy().convert("L"), flag=tr.FLAG_ROTATED_RECT)
-            plain_text = '|'.join([item[1] for item in res])
-            if '年' in plain_text or '登记' in plain_text or '统一' in plain_text or '营' in plain_text:
-                direction_is_right = True
-                break
-                
-        if '年' not in plain_text and '登记' not in plain_text and '统一' not in plain_text and '营' not in plain_text:
-            plain_text += '-----------问题数据-----------'
-            
-           
-        
-        
+        '''
+        是否开启图片压缩
+        默认使用 --max_size 启动参数
+        值为 0 时表示不开启压缩
+        非 0 时则在解码时压缩到该值的大小
+        '''
+        if compress_size is not None:
+            try:
+                compress_size = int(compress_size)
+            except ValueError as ex:
+                logger.error('compress参数类型有误', exc_info=True)
+                self.set_status(400)
+                self.finish(json.dumps({'code': 400, 'msg': 'compress参数类型有误，只能是int类型'}, cls=NpEncoder))
+                return
+
+        self.cancel = threading.Event()
+        timeout = self.request.headers.get(TIMEOUT_HEADER)
+        timer = None
+        if timeout is not None:
+            try:
+                timeout = parse_timeout(timeout)
+            except ValueError:
+                self.set_status(400)
+                self.finish(json.dumps({'code': 400, 'msg': f'{TIMEOUT_HEADER}只能是秒数'}, cls=NpEncoder))
+                return
+            timer = tornado.ioloop.IOLoop.current().call_later(max(timeout, 0), self.cancel.set)
+
+        # 进行ocr，不阻塞IOLoop
+        # 解码也在线程池里进行
+        try:
+            plain_text, rotation, info, stats = yield tornado.ioloop.IOLoop.current().run_in_executor(
+                ocr_executor, ocr, data, strategy, doc_type, compress_size, self.cancel)
+        except orientation.Cancelled:
+            self.set_status(504)
+            self.finish(json.dumps({'code': 504, 'msg': '请求超过期限或已断开，识别已取消'}, cls=NpEncoder))
+            return
+        finally:
+            if timer is not None:
+                tornado.ioloop.IOLoop.current().remove_timeout(timer)
+
         response_data = {'code': 200, 'msg': '成功',
                          'data': {'raw_out': plain_text + '------' + str(rotation),
                                   # 'image_size': ['1','2'],
+                                  'orientation': dict(info, rotation=rotation),
+                                  'preprocess': stats,
                                   'speed_time': round(time.time() - start_time, 2)}}
         # if is_draw != '0':
         #     img_detected = img.copy()
@@ -176,3 +276,84 @@ class TrRun(tornado.web.RequestHandler):
         self.finish(json.dumps(response_data,
                                cls=NpEncoder))
         return
+
+
+class TrRunBatch(TrRun):
+    '''
+    一次上传多张图片（多个file字段，或一个zip/tar压缩包），按完成顺序逐行返回NDJSON：
+    {"index": 序号, "name": 文件名, "status": 状态码, "elapsed_ms": 自请求开始的毫秒数, "result": 与 /api/tr-run/ 相同的结果}
+    查询参数 unpack=0 时不解压，每个上传文件对应一行结果（网关合并单张请求时使用）；
+    压缩包损坏等单个文件的问题只在该行返回400，整个请求的400只用于对所有图片都无效的参数
+    '''
+
+    @tornado.gen.coroutine
+    def post(self):
+        start_time = time.time()
+        strategy = self.get_argument("orientation", None)
+        doc_type = self.get_argument("doc_type", None)
+        compress_size = self.get_argument('compress', None)
+        # 只从查询参数读取，表单里同名的字段是客户端的参数
+        unpack = self.get_query_argument('unpack', '1') != '0'
+
+        self.set_header('content-type', 'application/json')
+        uploads = [(f.filename, f.body) for files in self.request.files.values() for f in files]
+        try:
+            images = batch.expand_items(uploads, unpack)
+        except batch.BatchError as ex:
+            self.set_status(400)
+            self.finish(json.dumps({'code': 400, 'msg': str(ex)}, cls=NpEncoder))
+            return
+        if not images:
+            self.set_status(400)
+            self.finish(json.dumps({'code': 400, 'msg': '没有传入图片'}, cls=NpEncoder))
+            return
+        if strategy is not None and strategy not in orientation.STRATEGIES:
+            self.set_status(400)
+            self.finish(json.dumps({'code': 400, 'msg': f'orientation参数只能是{"/".join(orientation.STRATEGIES)}'},
+                                   cls=NpEncoder))
+            return
+        if doc_type is not None and doc_type not in validators.VALIDATORS:
+            self.set_status(400)
+            self.finish(json.dumps({'code': 400, 'msg': f'doc_type参数只能是{"/".join(validators.VALIDATORS)}'},
+                                   cls=NpEncoder))
+            return
+        try:
+            compress_size = int(compress_size) if compress_size is not None else None
+            timeout = self.request.headers.get(TIMEOUT_HEADER)
+            timeout = parse_timeout(timeout)
+        except ValueError:
+            self.set_status(400)
+            self.finish(json.dumps({'code': 400, 'msg': f'compress只能是int类型，{TIMEOUT_HEADER}只能是秒数'},
+                                   cls=NpEncoder))
+            return
+
+        # 整批共用一个期限；所有图片一次提交，线程池按session数量并行执行
+        self.cancel = threading.Event()
+        io_loop = tornado.ioloop.IOLoop.current()
+        timer = io_loop.call_later(max(timeout, 0), self.cancel.set) if timeout is not None else None
+        futures = [io_loop.run_in_executor(ocr_executor, ocr_batch_item, index, name, data, strategy, doc_type,
+                                           compress_size, self.cancel, start_time)
+                   for index, (name, data, error) in enumerate(images) if error is None]
+
+        self.set_header('content-type', 'application/x-ndjson')
+        try:
+            for index, (name, _, error) in enumerate(images):
+                if error is not None:
+                    self.write(batch.result_line(index, name, 400, {'code': 400, 'msg': error},
+                                                 time.time() - start_time, cls=NpEncoder))
+            wait_iterator = tornado.gen.WaitIterator(*futures)
+            while not wait_iterator.done():
+                line = yield wait_iterator.next()
+                self.write(line)
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            # 客户端已断开，剩下的图片在检查点停止
+            self.cancel.set()
+            return
+        finally:
+            if timer is not None:
+                io_loop.remove_timeout(timer)
+        logger.info(json.dumps({'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                'batch': len(images), 'speed_time': round(time.time() - start_time, 2)},
+                               cls=NpEncoder))
+        self.finish()
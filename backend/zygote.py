@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+    Zygote：一次性完成import和.so切换（可选加载模型），之后按网关的指令fork出worker
+    fork出来的worker以copy-on-write方式继承已加载的模型，启动只需要几毫秒
+
+    协议（按行，文本）：
+        网关 -> zygote (stdin):   spawn <port>
+        zygote -> 网关 (stdout):  spawned <port> <pid>
+                                  exited <pid> <returncode>
+'''
+import os
+import sys
+import gc
+import signal
+import ctypes
+import argparse
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_PATH)
+
+PR_SET_PDEATHSIG = 1
+
+# stdout只用于和网关通信，其余输出（print/日志）全部转到stderr
+proto = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+
+def reply(line):
+    proto.write(line + '\n')
+    proto.flush()
+
+
+def reap_children(signum, frame):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        reply(f'exited {pid} {returncode}')
+
+
+def spawn(port, sessions):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    # 子进程
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    proto.close()
+    os.close(sys.stdin.fileno())
+    # zygote退出时子进程跟着退出，网关据此把它们标记为已退出
+    ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+
+    from backend.tools import orientation, preprocess, tiling
+    orientation.default_strategy = args.orientation
+    orientation.detect_size = args.detect_size
+    preprocess.default_max_size = args.max_size
+    tiling.tile_size = args.tile_size
+    tiling.tile_overlap = args.tile_overlap
+
+    from backend import main
+    try:
+        main.serve(port, sessions)
+    finally:
+        os._exit(0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="OCR worker zygote")
+    parser.add_argument('--open_gpu', type=int, default=0, help='是否开启gpu')
+    parser.add_argument('--orientation', type=str, default='probe', help='默认的方向判定策略: sequential/probe/speculative')
+    parser.add_argument('--max_size', type=int, default=0, help='解码后图片的最长边，0表示不压缩')
+    parser.add_argument('--detect_size', type=int, default=1600, help='检测时图片的最长边，0表示在原图上检测')
+    parser.add_argument('--tile_size', type=int, default=0, help='检测图最长边超过该值时分块检测，0表示不分块')
+    parser.add_argument('--tile_overlap', type=int, default=200, help='分块检测时相邻块的重叠宽度')
+    parser.add_argument('--preload_models', type=int, default=0,
+                        help='是否在fork前加载模型并初始化session；native库的推理线程不一定能在fork后使用，默认只预加载python模块')
+    args = parser.parse_args()
+
+    from backend.tools import manage_running_platform
+    manage_running_platform.change_version('cpu' if args.open_gpu == 0 else 'gpu')
+
+    # 预加载worker用到的全部模块
+    import numpy
+    import cv2
+    import PIL.Image
+    import tornado.web
+    import tornado.httpserver
+    import tornado.ioloop
+    from backend import main
+    if args.preload_models:
+        # import即加载 ctpn.bin / crnn.bin
+        from backend.webInterface import tr_run, tr_index, tr_ready
+
+    # 已加载的对象不再参与GC，避免GC扫描时写页面破坏copy-on-write
+    gc.collect()
+    gc.freeze()
+
+    signal.signal(signal.SIGCHLD, reap_children)
+    reply('ready')
+
+    for line in sys.stdin:
+        command = line.split()
+        if len(command) == 3 and command[0] == 'spawn':
+            port, sessions = int(command[1]), int(command[2])
+            if args.preload_models:
+                # 在fork前初始化session，子进程共享
+                tr_run.init_ocr_workers(sessions)
+            reply(f'spawned {port} {spawn(port, sessions)}')
@@ -1,16 +1,27 @@
+import math
 import time
 import numpy as np
 from tr import tr
+import batch
+import orientation
+import preprocess
+import tiling
+import validators
 from PIL import Image, ImageDraw
 import datetime
 import json
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
+from typing import List, Optional
 
 from loguru import logger
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Form, Query, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
 
 class NpEncoder(json.JSONEncoder):
@@ -24,7 +35,41 @@ class NpEncoder(json.JSONEncoder):
         else:
             return super(NpEncoder, self).default(obj)
 
-def inference(img: Image):
+# OCR放到线程池里执行，tr_run通过ctypes调用时会释放GIL，事件循环可以继续接收上传、响应探针
+# 线程数与可用的native session数量一致，每个线程执行时从tr的session池里借一组 (ctpn_id, crnn_id)
+ocr_executor = ThreadPoolExecutor(max_workers=tr.session_count(), thread_name_prefix='ocr')
+
+# 请求的剩余期限（秒），由网关转发时填写；超过期限或客户端断开后不再继续识别
+TIMEOUT_HEADER = 'X-Request-Timeout'
+
+
+def parse_timeout(value):
+    '''
+    :return: 请求头中的剩余秒数，没有该请求头时返回None
+    :raise ValueError: 不是有限的数
+    '''
+    if value is None:
+        return None
+    timeout = float(value)
+    if not math.isfinite(timeout):
+        raise ValueError(value)
+    return timeout
+
+
+def init_ocr_workers(num):
+    '''
+    初始化num组native session，并把线程池调整为同样的大小
+    '''
+    global ocr_executor
+    num = tr.init_sessions(num)
+    if ocr_executor._max_workers != num:
+        ocr_executor.shutdown(wait=False)
+        ocr_executor = ThreadPoolExecutor(max_workers=num, thread_name_prefix='ocr')
+    return num
+
+
+def inference(data: bytes, strategy: Optional[str] = None, doc_type: Optional[str] = None,
+              max_size: Optional[int] = None, cancel: Optional[threading.Event] = None):
     '''
 
     :return:
@@ -34,39 +79,31 @@ def inference(img: Image):
     '''
     start_time = time.time()
 
-    # 获取图像的宽度和高度
-    img_width, img_height = img.size
-    # 打印图像的尺寸
-    if img_width < img_height:
-        img = img.rotate(90, expand=True)
-        
-    img = img.convert("RGB")
-    original_img = img
+    # 在线程池里排队期间可能已经被取消
+    orientation.check_cancelled(cancel)
+    gray, stats = preprocess.decode_gray(data, max_size)
+    # 竖图先转成横图
+    if gray.shape[1] < gray.shape[0]:
+        gray = orientation.rotate(gray, 90)
 
     # 进行ocr
-    direction_is_right = False
-
-    for rotation in [0, 180, 270, 90]:
-        if rotation != 0:
-            img = original_img.copy().rotate(rotation, expand=True)
-            
-        # main inference entrance
-        res = tr.run(img.copy().convert("L"), flag=tr.FLAG_ROTATED_RECT)
-        
-        plain_text = '|'.join([item[1] for item in res])
-        if '年' in plain_text or '登记' in plain_text or '统一' in plain_text or '营' in plain_text:
-            direction_is_right = True
-            break
-            
-    if '年' not in plain_text and '登记' not in plain_text and '统一' not in plain_text and '营' not in plain_text:
+    with tr.session() as (ctpn_id, crnn_id), tr.track_copies() as copies:
+        plain_text, rotation, info = orientation.search(gray, strategy, ctpn_id, crnn_id,
+                                                        validators.get(doc_type), cancel)
+    info['doc_type'] = doc_type or validators.default_doc_type
+    # 解码之外，送进 tr 之前为得到连续内存而复制的次数和字节数
+    stats['copies'] = copies.copies
+    stats['copy_bytes'] = copies.bytes
+    stats['allocated_bytes'] = stats['decode_bytes'] + copies.bytes
+
+    if not info['valid']:
         plain_text += '-----------问题数据-----------'
-        
-        
-    
-    
+
     response_data = {'code': 200, 'msg': '成功',
                         'data': {'raw_out': plain_text + '------' + str(rotation),
                                 # 'image_size': ['1','2'],
+                                'orientation': dict(info, rotation=rotation),
+                                'preprocess': stats,
                                 'speed_time': round(time.time() - start_time, 2)}}
     log_info = {
         # 'ip': self.request.host,
@@ -79,26 +116,162 @@ def inference(img: Image):
     logger.info(json.dumps(log_info, cls=NpEncoder))
     return response_data
 
-app = FastAPI()
+
+def inference_batch_item(index: int, name: str, data: bytes, strategy: Optional[str], doc_type: Optional[str],
+                         max_size: Optional[int], cancel: threading.Event, batch_start: float):
+    '''
+    批量识别中的一张图片，出错只影响这一张
+    :return: 一行NDJSON结果
+    '''
+    try:
+        status, result = 200, inference(data, strategy, doc_type, max_size, cancel)
+    except orientation.Cancelled:
+        status, result = 504, {'code': 504, 'msg': '请求超过期限或已断开，识别已取消'}
+    except Exception as e:
+        logger.exception(f'批量识别 {name} 失败')
+        status, result = 500, {'code': 500, 'message': str(e)}
+    return batch.result_line(index, name, status, result, time.time() - batch_start, cls=NpEncoder)
+
+# 只有完成一次预热推理后才对外报告ready
+ready_state = {'ready': False, 'warmup_time': None, 'sessions': 0}
+
+
+def warmup():
+    '''
+    对每组session分别跑一次检测和识别，确保 ctpn.bin / crnn.bin 已加载且首次推理的开销已付清
+    '''
+    start_time = time.time()
+    for ctpn_id, crnn_id in tr.sessions():
+        tr.detect(np.zeros((64, 256), dtype=np.uint8), flag=tr.FLAG_ROTATED_RECT, ctpn_id=ctpn_id)
+        tr.recognize(np.zeros((32, 128), dtype=np.uint8), crnn_id=crnn_id)
+    ready_state['warmup_time'] = round(time.time() - start_time, 2)
+    ready_state['sessions'] = tr.session_count()
+    ready_state['ready'] = True
+    logger.info(f"warmup done: {ready_state['warmup_time']}s")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 先开始监听，再在后台预热；预热完成前 /api/ready 返回503
+    warmup_task = asyncio.get_running_loop().run_in_executor(ocr_executor, warmup)
+    try:
+        yield
+    finally:
+        await asyncio.wait([warmup_task])
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/api/ready")
+async def ready():
+    if not ready_state['ready']:
+        return JSONResponse(status_code=503, content={'code': 503, 'msg': 'warming up'})
+    return JSONResponse(content={'code': 200, 'msg': 'ready', 'data': ready_state})
+
+async def watch_disconnect(request: Request, cancel: threading.Event, interval: float = 0.5):
+    # 客户端（网关）断开后，OCR线程在下一个检查点停止
+    while not cancel.is_set():
+        if await request.is_disconnected():
+            cancel.set()
+            return
+        await asyncio.sleep(interval)
+
 
 @app.post("/api/tr-run")
-async def tr_serve(file: UploadFile = File(...)):
+async def tr_serve(request: Request, file: UploadFile = File(...),
+                   strategy: Optional[str] = Form(None, alias='orientation'),
+                   doc_type: Optional[str] = Form(None), compress: Optional[int] = Form(None)):
+    if strategy is not None and strategy not in orientation.STRATEGIES:
+        return JSONResponse(status_code=400, content={'code': 400, 'msg': f'orientation参数只能是{"/".join(orientation.STRATEGIES)}'})
+    if doc_type is not None and doc_type not in validators.VALIDATORS:
+        return JSONResponse(status_code=400, content={'code': 400, 'msg': f'doc_type参数只能是{"/".join(validators.VALIDATORS)}'})
+    timeout = request.headers.get(TIMEOUT_HEADER)
+    try:
+        timeout = parse_timeout(timeout)
+    except ValueError:
+        return JSONResponse(status_code=400, content={'code': 400, 'msg': f'{TIMEOUT_HEADER}只能是秒数'})
+
+    loop = asyncio.get_running_loop()
+    cancel = threading.Event()
+    timer = loop.call_later(max(timeout, 0), cancel.set) if timeout is not None else None
+    watcher = asyncio.create_task(watch_disconnect(request, cancel))
     try:
         # # 检查文件类型是否为图像类型
         # if not file.content_type.startswith("image/"):
         #     return JSONResponse(status_code=400, content={"message": "上传的文件不是图片"})
 
-        # 读取图片并转化为PIL.Image
+        # 读取图片，解码在inference里进行
         image_data = await file.read()
-        img = Image.open(BytesIO(image_data))
 
-        # 调用inference函数处理图片
-        response_data = inference(img)
+        # 调用inference函数处理图片，不阻塞事件循环
+        response_data = await loop.run_in_executor(ocr_executor, inference, image_data, strategy, doc_type,
+                                                   compress, cancel)
         
         return JSONResponse(content=response_data)
 
+    except orientation.Cancelled:
+        return JSONResponse(status_code=504, content={'code': 504, 'msg': '请求超过期限或已断开，识别已取消'})
     except Exception as e:
         return JSONResponse(status_code=500, content={"message": str(e)})
+    finally:
+        if timer is not None:
+            timer.cancel()
+        watcher.cancel()
+
+
+@app.post("/api/tr-run-batch")
+async def tr_serve_batch(request: Request, file: List[UploadFile] = File(...),
+                         strategy: Optional[str] = Form(None, alias='orientation'),
+                         doc_type: Optional[str] = Form(None), compress: Optional[int] = Form(None),
+                         unpack: int = Query(1)):
+    '''
+    一次上传多张图片（多个file字段，或一个zip/tar压缩包），按完成顺序逐行返回NDJSON：
+    {"index": 序号, "name": 文件名, "status": 状态码, "elapsed_ms": 自请求开始的毫秒数, "result": 与 /api/tr-run 相同的结果}
+    查询参数 unpack=0 时不解压，每个上传文件对应一行结果（网关合并单张请求时使用）；
+    压缩包损坏等单个文件的问题只在该行返回400，整个请求的400只用于对所有图片都无效的参数
+    '''
+    start_time = time.time()
+    if strategy is not None and strategy not in orientation.STRATEGIES:
+        return JSONResponse(status_code=400, content={'code': 400, 'msg': f'orientation参数只能是{"/".join(orientation.STRATEGIES)}'})
+    if doc_type is not None and doc_type not in validators.VALIDATORS:
+        return JSONResponse(status_code=400, content={'code': 400, 'msg': f'doc_type参数只能是{"/".join(validators.VALIDATORS)}'})
+    timeout = request.headers.get(TIMEOUT_HEADER)
+    try:
+        timeout = parse_timeout(timeout)
+    except ValueError:
+        return JSONResponse(status_code=400, content={'code': 400, 'msg': f'{TIMEOUT_HEADER}只能是秒数'})
+    try:
+        images = batch.expand_items([(upload.filename, await upload.read()) for upload in file], bool(unpack))
+    except batch.BatchError as e:
+        return JSONResponse(status_code=400, content={'code': 400, 'msg': str(e)})
+    if not images:
+        return JSONResponse(status_code=400, content={'code': 400, 'msg': '没有传入图片'})
+
+    # 整批共用一个期限；所有图片一次提交，线程池按session数量并行执行
+    loop = asyncio.get_running_loop()
+    cancel = threading.Event()
+    timer = loop.call_later(max(timeout, 0), cancel.set) if timeout is not None else None
+    futures = [loop.run_in_executor(ocr_executor, inference_batch_item, index, name, data, strategy, doc_type,
+                                    compress, cancel, start_time)
+               for index, (name, data, error) in enumerate(images) if error is None]
+
+    async def stream():
+        try:
+            for index, (name, _, error) in enumerate(images):
+                if error is not None:
+                    yield batch.result_line(index, name, 400, {'code': 400, 'msg': error}, time.time() - start_time,
+                                            cls=NpEncoder)
+            for future in asyncio.as_completed(futures):
+                yield await future
+        finally:
+            # 正常结束时不影响；客户端断开时生成器被关闭，剩下的图片在检查点停止
+            cancel.set()
+            if timer is not None:
+                timer.cancel()
+            logger.info(f'batch {len(images)}: {round(time.time() - start_time, 2)}s')
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
 
 
 if __name__ == '__main__':
@@ -108,9 +281,23 @@ if __name__ == '__main__':
 
     # 添加port参数，默认为6006
     parser.add_argument('--port', type=int, default=6006, help='Port to run the FastAPI server on')
+    parser.add_argument('--sessions', type=int, default=1, help='进程内native session数量，即可同时进行的OCR数量')
+    parser.add_argument('--orientation', type=str, default='probe', choices=orientation.STRATEGIES,
+                        help='默认的方向判定策略')
+    parser.add_argument('--max_size', type=int, default=0, help='解码后图片的最长边，0表示不压缩；请求的compress参数可以覆盖')
+    parser.add_argument('--detect_size', type=int, default=1600, help='检测时图片的最长边，识别仍使用原图；0表示在原图上检测')
+    parser.add_argument('--tile_size', type=int, default=0, help='检测图最长边超过该值时分块检测；0表示不分块')
+    parser.add_argument('--tile_overlap', type=int, default=200, help='分块检测时相邻块的重叠宽度')
 
     # 解析命令行参数
     args = parser.parse_args()
 
+    init_ocr_workers(args.sessions)
+    orientation.default_strategy = args.orientation
+    orientation.detect_size = args.detect_size
+    preprocess.default_max_size = args.max_size
+    tiling.tile_size = args.tile_size
+    tiling.tile_overlap = args.tile_overlap
+
     # 使用指定的端口运行服务器
     uvicorn.run(app, host='0.0.0.0', port=args.port)
\ No newline at end of file
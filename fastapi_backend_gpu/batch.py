@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+    批量识别的公共部分：把上传的文件（多个图片，或zip/tar压缩包）展开成图片列表，
+    以及每张图片一行的NDJSON结果
+'''
+
+import io
+import json
+import tarfile
+import zipfile
+
+max_batch_images = 10000  # 一次批量请求最多的图片数
+max_image_bytes = 64 * 1024 * 1024  # 压缩包内单个文件解压后的上限
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp', '.gif')
+
+
+class BatchError(ValueError):
+    pass
+
+
+def _is_image_name(name):
+    base = name.rsplit('/', 1)[-1]
+    # 跳过macOS压缩时附带的元数据文件
+    return not base.startswith('.') and '__MACOSX/' not in name and base.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _expand_zip(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not _is_image_name(info.filename):
+                continue
+            if info.file_size > max_image_bytes:
+                yield info.filename, None, f'{info.filename} 超过 {max_image_bytes} 字节'
+            else:
+                yield info.filename, archive.read(info), None
+
+
+def _expand_tar(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        for member in archive:
+            if not member.isfile() or not _is_image_name(member.name):
+                continue
+            if member.size > max_image_bytes:
+                yield member.name, None, f'{member.name} 超过 {max_image_bytes} 字节'
+            else:
+                yield member.name, archive.extractfile(member).read(), None
+
+
+def _is_tar(data):
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data)):
+            return True
+    except tarfile.TarError:
+        return False
+
+
+def expand_items(uploads, unpack=True):
+    '''
+    与expand_uploads相同，但单个文件的问题（压缩包损坏、解压后过大）只作为该项的错误返回，不影响其他图片
+    :param uploads: [(filename, bytes)]
+    :param unpack: 为False时不解压，每个上传文件原样作为一项，结果与上传文件一一对应
+    :return: [(name, bytes, error)]，error不为None时bytes为None
+    :raise BatchError: 图片数超过上限
+    '''
+    items = []
+    for filename, data in uploads:
+        filename = filename or f'{len(items)}'
+        if not unpack:
+            entries = [(filename, data, None)]
+        elif zipfile.is_zipfile(io.BytesIO(data)):
+            entries = _expand_zip(data)
+        elif not _is_image_name(filename) and _is_tar(data):
+            entries = _expand_tar(data)
+        else:
+            entries = [(filename, data, None)]
+        start = len(items)
+        try:
+            for entry in entries:
+                items.append(entry)
+                if len(items) > max_batch_images:
+                    raise BatchError(f'一次最多识别 {max_batch_images} 张图片')
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError) as ex:
+            # 丢弃已展开的部分，整个压缩包作为一项错误
+            del items[start:]
+            items.append((filename, None, f'{filename} 解压失败: {ex}'))
+    return items
+
+
+def expand_uploads(uploads):
+    '''
+    :param uploads: [(filename, bytes)]，每项是一张图片或一个zip/tar(.gz/.bz2/.xz)压缩包
+    :return: [(name, bytes)]，按上传顺序和压缩包内的顺序排列
+    :raise BatchError: 图片数超过上限或压缩包损坏
+    '''
+    images = []
+    for name, data, error in expand_items(uploads):
+        if error is not None:
+            raise BatchError(error)
+        images.append((name, data))
+    return images
+
+
+def result_line(index, name, status, result, elapsed, cls=None):
+    '''
+    :return: 一行NDJSON（含换行）
+    '''
+    return json.dumps({'index': index, 'name': name, 'status': status,
+                       'elapsed_ms': round(elapsed * 1000, 2), 'result': result},
+                      ensure_ascii=False, cls=cls) + '\n'
+
+
+def parse_result_lines(content, count):
+    '''
+    解析 /api/tr-run-batch 返回的NDJSON，并按index排序
+    :param content: 完整的响应体
+    :param count: 上传的图片数
+    :return: [dict]，第i项是index为i的那一行
+    :raise BatchError: 行数与count不符，或index越界、重复
+    '''
+    lines = [None] * count
+    for line in content.split(b'\n'):
+        if not line.strip():
+            continue
+        try:
+            line = json.loads(line)
+            index, _, _ = line['index'], line['status'], line['result']
+        except (ValueError, TypeError, KeyError) as ex:
+            raise BatchError(f'无法解析的结果行: {ex}')
+        if not isinstance(index, int) or not 0 <= index < count or lines[index] is not None:
+            raise BatchError(f'结果行的index {index!r} 越界或重复')
+        lines[index] = line
+    if any(line is None for line in lines):
+        raise BatchError(f'结果行数少于 {count}')
+    return lines
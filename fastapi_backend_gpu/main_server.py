@@ -1,30 +1,154 @@
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
 import asyncio
+import os
+import signal
 import subprocess
+import shlex
 import aiohttp
+import time
+import random
+import math
+import json
+import uuid
 from collections import deque
-from typing import Deque, Dict, Tuple
+from typing import Deque, Dict, Optional, Tuple
 
 from loguru import logger
 import gc
 import uvicorn
 
+import batch
+import job_store as jobs
+import result_cache
+
 ports = [8000 + i for i in range(1, 4)]
 
 # global variables
 index = 0
-request_queue: Deque[Tuple[Request, asyncio.Future]] = deque()      # NOTE: use async lock!
+# 队列、锁、条件变量、事件都在lifespan里创建：Python 3.7~3.9在构造时就绑定get_event_loop()，
+# 而uvicorn可能在另一个事件循环上运行，模块导入时创建会导致 "attached to a different loop"
+# 队列中的元素为 (request, future, enqueued_at, deadline, micro_batch_item)，见micro_batch_item
+request_queue: "Optional[asyncio.Queue[Tuple[Request, asyncio.Future, float, Optional[float], Optional[tuple]]]]" = None  # FIFO，由唯一的dispatcher消费
 in_flight_requests: Dict[int, int] = {}                             # NOTE: use async lock!
 slot_status: Dict[int, int] = {}                                    # NOTE: use async lock!  为0的时候表示没事，为1的时候表示请勿再输送，正在重启
 max_in_flight_requests = 5  # 5的时候是最高的，10反而会下降
-lock = asyncio.Lock()
+lock: Optional[asyncio.Lock] = None
+slot_freed: Optional[asyncio.Condition] = None                      # in_flight_requests / slot_status 变化时notify，唤醒dispatcher，与lock共用
+dispatcher_task: Optional[asyncio.Task] = None
+handler_tasks = set()                                               # 持有handle_request任务的引用，避免被GC
+
+# 每个子进程一个长连接池，避免每个请求都重新建立TCP连接
+backend_sessions: Dict[int, aiohttp.ClientSession] = {}
+pool_connection_limit = max_in_flight_requests                      # 每个连接池的最大连接数，与max_in_flight_requests对齐
+pool_keepalive_timeout = 60                                         # 空闲连接保活时间（秒）
+HOP_BY_HOP_HEADERS = {'host', 'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'te', 'trailer', 'upgrade'}
 
 # 容灾操作
-processes: Dict[int, asyncio.subprocess.Process] = {}               # NOTE: use async lock!
-request_tracker: Dict[int, int] = {port : 0 for port in ports}      # NOTE: use async lock!
-request_limits: Dict[int, int] = {}     # 每个子进程最大承载的请求数量，呈阶梯状分布，避免容灾失败。比如300， 400， 500
-restart_server_flag = False                                         # NOTE: use async lock!
+worker_sessions = 1                                                 # 每个子进程内的native session数量
+WORKER_COMMAND = "python api_server.py --port={port} --sessions={sessions}"
+processes: Dict[int, asyncio.subprocess.Process] = {}               # NOTE: use async lock!  zygote模式下为ZygoteChild
+request_tracker: Dict[int, int] = {}                                # 每个子进程自上次启动以来处理的请求数，仅用于统计
+
+# 按内存回收子进程：定期采样子进程RSS，超过阈值才重启，而不是按请求数或500猜测OOM
+max_worker_rss_mb = 3072                                            # 0 表示不按内存回收
+rss_sample_interval = 5.0                                           # 采样间隔（秒）
+drain_timeout = 120.0                                               # 回收前等待in-flight请求结束的最长时间（秒）
+worker_rss: Dict[int, int] = {}                                     # 最近一次采样的RSS（字节）
+recycle_lock: Optional[asyncio.Lock] = None                         # 同一时间只允许一个子进程重启
+recycle_counts: Dict[int, int] = {}
+retired_ports = set()                                               # 已被替换、进程已停止但仍有请求未结束的端口，计数归零后放回备用端口
+monitor_task: Optional[asyncio.Task] = None
+
+# 零停机替换：新子进程在备用端口上就绪后先接入流量，再排空并停止旧进程
+WORKER_READY_PATH = "/api/ready"
+worker_ready_timeout = 180.0                                        # 等待子进程预热完成的最长时间（秒）
+spare_ports: Deque[int] = deque([8000 + len(ports) + 1])            # 没有进程的备用端口
+standby_ports: Deque[int] = deque()                                 # 已就绪但还未接入流量的热备进程
+warm_standby = 0                                                    # 为1时常驻一个热备进程，替换时无需等待启动
+standby_task: Optional[asyncio.Task] = None
+
+# Zygote模式：由一个预先加载好模块的进程fork出子进程，重启只需几毫秒
+zygote_mode = 0
+# 是否在fork前加载模型并创建native session；未验证libtr的推理线程在fork后可用之前默认关闭，
+# 子进程在fork后自己加载模型，仍省去import的时间
+zygote_preload_models = 0
+ZYGOTE_COMMAND = "python zygote.py"
+zygote_process: Optional[asyncio.subprocess.Process] = None
+zygote_lock: Optional[asyncio.Lock] = None                          # 串行化spawn指令
+zygote_ready: Optional[asyncio.Future] = None
+zygote_reader_task: Optional[asyncio.Task] = None
+zygote_pending_spawns: Dict[int, asyncio.Future] = {}               # port -> 等待spawned回复的future
+zygote_children: Dict[int, "ZygoteChild"] = {}                      # pid -> 子进程
+zygote_early_exits: Dict[int, int] = {}                             # pid -> 退出码，exited先于spawned到达时暂存
+
+# 负载均衡策略：first_free(原有的顺序选择) / least_in_flight / ewma / p2c
+balance_policy = 'least_in_flight'
+ewma_alpha = 0.3                                                    # 服务耗时EWMA的平滑系数
+service_time_ewma: Dict[int, float] = {}                            # 每个端口观测到的服务耗时EWMA（秒）
+dispatch_counts: Dict[int, int] = {}                                # 每个端口被分发的请求数
+
+# 排队耗时统计（秒），通过 /api/gateway-stats 暴露
+queue_wait_stats = {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0}
+recent_queue_waits: Deque[float] = deque(maxlen=1024)              # 最近的排队耗时，用于计算分位数
+
+# 结果缓存：相同图片和参数的请求直接返回之前的结果，持久化在SQLite文件中，重启后依然有效
+cache_enabled = 1
+cache_path = 'ocr_result_cache.sqlite3'
+cache_max_entries = 10000
+cache_max_mb = 512
+cache_ttl = 24 * 3600.                                              # 结果的有效期（秒），0表示不过期
+CACHE_BYPASS_FIELD = 'no_cache'                                     # 查询参数或表单字段，非0时跳过查找并刷新缓存
+cache: Optional[result_cache.ResultCache] = None
+
+# 单飞(single-flight)：缓存键相同的并发请求合并为一次后端调用，所有等待者共享结果
+single_flight = 1
+flights: Dict[str, "Flight"] = {}
+single_flight_stats = {'leaders': 0, 'coalesced': 0, 'handoffs': 0}
+
+# 准入控制：排队过长时快速拒绝，而不是把请求体全部堆在内存里等待
+max_queue_depth = 0                                                 # 排队请求数上限，0表示不限
+max_queue_wait = 0.                                                 # 排队耗时上限（秒），超过的请求不再转发；0表示不限
+client_quota = 0                                                    # 每个客户端（API Key或IP）同时处理的请求数上限，0表示不限
+CLIENT_KEY_HEADER = 'x-api-key'
+client_active: Dict[str, int] = {}
+drain_window = 30.                                                  # 统计完成速率的时间窗口（秒）
+max_retry_after = 60                                                # Retry-After的上限（秒）
+recent_completions: Deque[float] = deque(maxlen=4096)               # 最近完成请求的时间，用于计算完成速率
+admission_stats = {'rejected_queue_full': 0, 'rejected_queue_wait': 0, 'rejected_quota': 0, 'shed_deadline': 0}
+
+# 请求期限：客户端用请求头给出（秒），否则使用默认值；排队、转发和子进程识别时都会检查
+TIMEOUT_HEADER = 'x-request-timeout'
+default_request_timeout = 0.                                        # 0表示没有默认期限
+disconnect_poll_interval = 0.5                                      # 检查客户端是否断开的间隔（秒）
+deadline_stats = {'expired_in_queue': 0, 'expired': 0, 'disconnected': 0}
+DEADLINE_CONTENT = json.dumps({'code': 504, 'msg': '请求超过期限'}, ensure_ascii=False).encode()
+
+# 批量识别：一次请求上传多张图片，逐张进入同一个队列，结果按完成顺序以NDJSON返回
+batch_concurrency = 0                                               # 每个批量请求同时排队/处理的图片数，0表示与总slot数一致
+batch_stats = {'batches': 0, 'images': 0, 'active': 0}
+
+# 微批：dispatcher拿到slot后，把窗口内到达、参数相同的单张请求合成一次对子进程 /api/tr-run-batch 的调用
+micro_batch_max = 1                                                 # 每批最多的请求数，1表示不合并
+micro_batch_window_ms = 0.                                          # 凑批时最多等待的时间（毫秒）
+micro_batch_max_kb = 256                                            # 图片超过该大小的请求不合并，微批针对小图
+deferred_requests: Deque[tuple] = deque()                           # 凑批时取出但不能合并的请求，下次优先调度
+micro_batch_stats = {'batches': 0, 'items': 0, 'max_size': 0, 'sizes': {}}
+
+# 异步任务：提交后立即返回任务id，图片和结果保存在本地SQLite，由任务协程逐张送入同一个队列
+jobs_enabled = 1
+job_path = 'ocr_jobs.sqlite3'
+job_concurrency = 0                                                 # 同时排队/处理的任务条目数，0表示与总slot数一致
+job_max_attempts = 3                                                # 条目因过载、子进程故障失败时的最多尝试次数
+job_max_pending = 0                                                 # 未完成的条目数上限，超过时拒绝提交，0表示不限
+job_retention = 7 * 24 * 3600.                                      # 完成的任务保留时间（秒），0表示一直保留
+job_poll_interval = 1.                                              # 没有新提交时检查排队条目的间隔（秒）
+job_webhook_attempts = 5                                            # 回调失败时的最多尝试次数
+job_store: Optional[jobs.JobStore] = None
+job_wakeup: Optional[asyncio.Event] = None                          # 提交新任务时唤醒任务协程
+job_tasks = []
+webhook_tasks = set()
 
 # # use lock operation
 # async def get_request_future() -> tuple:
@@ -37,15 +161,122 @@ restart_server_flag = False                                         # NOTE: use
 #             return None, None
 
 
+class ZygoteChild:
+    '''
+    由zygote fork出来的子进程，接口与asyncio.subprocess.Process保持一致；
+    网关不是它的父进程，退出码由zygote通过 exited 消息转告
+    '''
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.returncode: Optional[int] = None
+        self._exited = asyncio.Event()
+
+    def set_exited(self, returncode: int):
+        self.returncode = returncode
+        self._exited.set()
+
+    def terminate(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    async def wait(self) -> int:
+        await self._exited.wait()
+        return self.returncode
+
+
+async def read_zygote(process: asyncio.subprocess.Process):
+    while True:
+        line = await process.stdout.readline()
+        if not line:
+            break
+        command = line.decode().split()
+        if command == ['ready']:
+            if not zygote_ready.done():
+                zygote_ready.set_result(True)
+        elif len(command) == 3 and command[0] == 'spawned':
+            child = ZygoteChild(int(command[2]))
+            if child.pid in zygote_early_exits:
+                # 子进程在zygote回复spawned之前就已退出
+                child.set_exited(zygote_early_exits.pop(child.pid))
+            else:
+                zygote_children[child.pid] = child
+            future = zygote_pending_spawns.pop(int(command[1]), None)
+            if future is not None and not future.done():
+                future.set_result(child)
+        elif len(command) == 3 and command[0] == 'exited':
+            child = zygote_children.pop(int(command[1]), None)
+            if child is not None:
+                child.set_exited(int(command[2]))
+            else:
+                zygote_early_exits[int(command[1])] = int(command[2])
+
+    # zygote退出后，子进程会收到PDEATHSIG跟着退出
+    logger.error("zygote已退出")
+    if not zygote_ready.done():
+        zygote_ready.set_result(False)
+    for child in zygote_children.values():
+        child.set_exited(-signal.SIGTERM)
+    zygote_children.clear()
+    zygote_early_exits.clear()
+    for future in zygote_pending_spawns.values():
+        if not future.done():
+            future.set_exception(RuntimeError("zygote exited"))
+    zygote_pending_spawns.clear()
+
+
+async def start_zygote() -> bool:
+    global zygote_process, zygote_ready, zygote_reader_task
+    zygote_ready = asyncio.get_running_loop().create_future()
+    zygote_process = await asyncio.create_subprocess_exec(
+        *shlex.split(ZYGOTE_COMMAND), f'--preload_models={zygote_preload_models}',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    zygote_reader_task = asyncio.create_task(read_zygote(zygote_process))
+    try:
+        return await asyncio.wait_for(asyncio.shield(zygote_ready), worker_ready_timeout)
+    except asyncio.TimeoutError:
+        return False
+
+
+async def stop_zygote():
+    global zygote_process
+    if zygote_process is None:
+        return
+    if zygote_process.returncode is None:
+        # 关闭stdin后zygote退出，剩余子进程随之退出
+        zygote_process.stdin.close()
+        await zygote_process.wait()
+    if zygote_reader_task is not None:
+        await zygote_reader_task
+    zygote_process = None
+
+
+async def spawn_from_zygote(port: int) -> ZygoteChild:
+    async with zygote_lock:
+        if zygote_process is None or zygote_process.returncode is not None:
+            if not await start_zygote():
+                raise RuntimeError("zygote failed to start")
+        future = asyncio.get_running_loop().create_future()
+        zygote_pending_spawns[port] = future
+        zygote_process.stdin.write(f"spawn {port} {worker_sessions}\n".encode())
+        await zygote_process.stdin.drain()
+        return await future
+
+
 # 定义启动子进程的函数
 async def start_subprocess(port: int):
     global processes, lock
-    command = f"python api_server.py --port={port}"
-    process = await asyncio.create_subprocess_shell(
-        command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+    if zygote_mode:
+        process = await spawn_from_zygote(port)
+    else:
+        # 直接exec而不经过shell，process.pid才是子进程本身，便于读取/proc/<pid>/status
+        # stdout/stderr继承网关的输出，PIPE不读取会在缓冲区写满后把子进程卡死
+        process = await asyncio.create_subprocess_exec(*shlex.split(WORKER_COMMAND.format(port=port, sessions=worker_sessions)))
     async with lock:
         processes[port] = process
     return process
@@ -66,8 +297,10 @@ async def stop_subprocess(port: int):
         async with lock:
             del processes[port]
 
-# Restart a subprocess if it exceeds the request limit
+# Restart a subprocess
 async def restart_subprocess(port: int):
+    # 旧进程的长连接全部失效，先关闭连接池，下次请求时重新建立
+    await close_backend_session(port)
     # Stop the subprocess
     await stop_subprocess(port)
     
@@ -76,175 +309,1377 @@ async def restart_subprocess(port: int):
     return process
 
 
+def read_rss(pid: int) -> Optional[int]:
+    '''
+    从 /proc/<pid>/status 读取常驻内存，单位字节；进程不存在时返回None
+    '''
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError, ValueError):
+        return None
+    return None
+
+
+async def wait_until_ready(port: int, timeout: float = None) -> bool:
+    '''
+    轮询子进程的就绪探针，直到预热完成；进程退出或超时返回False
+    '''
+    timeout = worker_ready_timeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    url = f"http://localhost:{port}{WORKER_READY_PATH}"
+    while time.monotonic() < deadline:
+        process = processes.get(port)
+        if process is None or process.returncode is not None:
+            return False
+        try:
+            async with get_backend_session(port).get(url) as response:
+                if response.status == 200:
+                    return True
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    return False
+
+
+async def start_ready_worker(port: int) -> bool:
+    await start_subprocess(port)
+    if await wait_until_ready(port):
+        return True
+    logger.warning(f"server:{port} 未能在{worker_ready_timeout}s内就绪")
+    await close_backend_session(port)
+    await stop_subprocess(port)
+    return False
+
+
+async def obtain_replacement() -> Optional[int]:
+    '''
+    获取一个已就绪的替换进程：优先使用热备进程，否则在备用端口上现场启动
+    '''
+    while standby_ports:
+        port = standby_ports.popleft()
+        process = processes.get(port)
+        if process is not None and process.returncode is None:
+            return port
+        await close_backend_session(port)
+        await stop_subprocess(port)
+        spare_ports.append(port)
+
+    if not spare_ports:
+        return None
+    port = spare_ports.popleft()
+    if await start_ready_worker(port):
+        return port
+    spare_ports.append(port)
+    return None
+
+
+async def ensure_standby():
+    if not warm_standby or standby_ports or not spare_ports:
+        return
+    port = spare_ports.popleft()
+    if await start_ready_worker(port):
+        standby_ports.append(port)
+        logger.info(f"热备进程 server:{port} 已就绪")
+    else:
+        spare_ports.append(port)
+
+
+def schedule_standby():
+    global standby_task
+    if warm_standby and (standby_task is None or standby_task.done()):
+        standby_task = asyncio.create_task(ensure_standby())
+
+
+async def drain_worker(port: int):
+    '''
+    停止向port分发新请求，并等待其in-flight请求结束；调用方需持有slot_freed
+    '''
+    slot_status[port] = 1  # 赋值为1，拒绝其他请求再进入
+    slot_freed.notify_all()
+    try:
+        # release_slot会notify，不需要轮询
+        await asyncio.wait_for(slot_freed.wait_for(lambda: in_flight_requests[port] == 0), drain_timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"server:{port} 在{drain_timeout}s内未排空，强制停止")
+
+
+async def recycle_worker(port: int, reason: str):
+    '''
+    回收子进程。有备用端口时先让替换进程就绪并接入流量，再排空、停止旧进程，整个过程不损失容量；
+    没有备用端口时退化为原地重启：排空 -> 重启 -> 等待就绪 -> 恢复分发
+    '''
+    async with recycle_lock:
+        logger.info(f"回收 server:{port}，原因: {reason}")
+        new_port = await obtain_replacement()
+
+        if new_port is not None:
+            async with slot_freed:
+                # 先接入新进程，再排空旧进程
+                in_flight_requests[new_port] = 0
+                slot_status[new_port] = 0
+                request_tracker[new_port] = 0
+                await drain_worker(port)
+                request_tracker.pop(port, None)
+                worker_rss.pop(port, None)
+                service_time_ewma.pop(port, None)
+                recycle_counts[new_port] = recycle_counts.pop(port, 0) + 1
+
+            await close_backend_session(port)
+            await stop_subprocess(port)
+            async with slot_freed:
+                # 排空超时时仍有请求在途；连接和进程都已关闭，它们很快会以错误结束。
+                # 计数归零之前保留端口（slot_status为1，不会再被选中），release_slot才能正常完成这些请求
+                try:
+                    await asyncio.wait_for(slot_freed.wait_for(lambda: in_flight_requests[port] == 0), drain_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                if in_flight_requests[port]:
+                    logger.warning(f"server:{port} 仍有 {in_flight_requests[port]} 个请求未结束，结束后再放回备用端口")
+                    retired_ports.add(port)
+                else:
+                    del in_flight_requests[port]
+                    del slot_status[port]
+                    spare_ports.append(port)
+            logger.info(f"server:{port} 已由 server:{new_port} 替换")
+            schedule_standby()
+            return
+
+        async with slot_freed:
+            await drain_worker(port)
+
+        try:
+            await restart_subprocess(port)
+            if await wait_until_ready(port):
+                logger.info(f"server:{port} 重启成功!")
+        finally:
+            async with slot_freed:
+                request_tracker[port] = 0
+                worker_rss.pop(port, None)
+                recycle_counts[port] = recycle_counts.get(port, 0) + 1
+                slot_status[port] = 0  # 允许其他请求进入
+                slot_freed.notify_all()
+
+
+async def monitor_workers():
+    '''
+    定期检查子进程：进程已退出则立即拉起，RSS超过阈值则回收
+    '''
+    while True:
+        await asyncio.sleep(rss_sample_interval)
+        for port in list(in_flight_requests):
+            if port not in in_flight_requests or port in retired_ports:
+                # 已在本轮中被替换
+                continue
+            process = processes.get(port)
+            if process is None or process.returncode is not None:
+                await recycle_worker(port, f"进程已退出: {process.returncode if process else None}")
+                continue
+
+            rss = read_rss(process.pid)
+            if rss is None:
+                continue
+            worker_rss[port] = rss
+            if max_worker_rss_mb and rss > max_worker_rss_mb * 1024 * 1024:
+                await recycle_worker(port, f"RSS {rss / 1024 / 1024:.0f}MB 超过阈值 {max_worker_rss_mb}MB")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global ports, processes, request_limits, in_flight_requests, slot_status
+    global ports, processes, in_flight_requests, slot_status, dispatcher_task, monitor_task, spare_ports, cache
+    global job_store, request_queue, lock, slot_freed, recycle_lock, zygote_lock, job_wakeup
+    # 在服务所用的事件循环里创建
+    request_queue = asyncio.Queue()
+    lock = asyncio.Lock()
+    slot_freed = asyncio.Condition(lock)
+    recycle_lock = asyncio.Lock()
+    zygote_lock = asyncio.Lock()
+    job_wakeup = asyncio.Event()
+    if cache_enabled:
+        cache = result_cache.ResultCache(cache_path, cache_max_entries, cache_max_mb * 1024 * 1024, cache_ttl)
+    if jobs_enabled:
+        job_store = jobs.JobStore(job_path)
+
     
     # 启动子进程
     for port in ports:
         process = await start_subprocess(port)
         
-    # 确保子进程启动成功
-    for process in processes.values():
-        await asyncio.sleep(2)  # 可调整为合适的等待时间
-        if process.returncode is not None:
-            print(f"Subprocess failed to start: {process.returncode}")
+    # 等待子进程预热完成，而不是固定sleep
+    ready = await asyncio.gather(*(wait_until_ready(port) for port in ports))
+    for port, is_ready in zip(ports, ready):
+        if not is_ready:
+            process = processes.get(port)
+            logger.error(f"Subprocess {port} failed to become ready: {process.returncode if process else None}")
+
+    # 过滤掉与工作端口重复的备用端口
+    spare_ports = deque(port for port in spare_ports if port not in ports)
             
-    
     for port in ports:
         # 初始化in-flight记录器
         in_flight_requests[port] = 0
-        
-        # 初始化request_limits
-        cnt = port - 8000
-        request_limits[port] = 50 + (cnt - 1)*15
+        request_tracker[port] = 0
         
         # 初始化slot_status
         slot_status[port] = 0
 
+    # 启动唯一的调度协程
+    dispatcher_task = asyncio.create_task(dispatch_request_queue())
+    monitor_task = asyncio.create_task(monitor_workers())
+    schedule_standby()
+    if job_store is not None:
+        await start_jobs()
     
     try:
         yield
     finally:
+        for task in job_tasks + list(webhook_tasks):
+            task.cancel()
+        monitor_task.cancel()
+        dispatcher_task.cancel()
+        if standby_task is not None:
+            standby_task.cancel()
+        for port in list(backend_sessions):
+            await close_backend_session(port)
         # 停止所有子进程
-        for process in processes.values():
-            process.terminate()
-            await process.wait()
+        for port in list(processes):
+            await stop_subprocess(port)
+        await stop_zygote()
+        if cache is not None:
+            cache.close()
+        if job_store is not None:
+            # 未完成的条目保持running，下次启动时重新排队
+            if job_tasks:
+                await asyncio.wait(job_tasks)
+            job_store.close()
             
 
 app = FastAPI(lifespan=lifespan)
 
 
+def get_backend_session(port: int) -> aiohttp.ClientSession:
+    '''
+    获取端口对应的长连接池，不存在时创建
+    '''
+    session = backend_sessions.get(port)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=pool_connection_limit,
+            keepalive_timeout=pool_keepalive_timeout,
+        )
+        # 不同客户端共用一个session，不能在session里保存cookie
+        session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+        backend_sessions[port] = session
+    return session
+
+
+async def close_backend_session(port: int):
+    session = backend_sessions.pop(port, None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
 # 转发请求到后端服务的函数
-async def forward_request_to_backend(request: Request, selected_port: int):
+async def forward_request_to_backend(request: Request, selected_port: int, deadline: Optional[float] = None):
     global index
     url = f"http://localhost:{selected_port}/api/tr-run/"
     
-    headers = {key: value for key, value in request.headers.items() if key != "host"}
+    # 逐跳头（Connection等）不能转发，否则会关掉连接池里的长连接
+    # 期限头由网关按剩余时间重新填写，客户端的原值（包括表示不限的0）不能直接转发
+    headers = {key: value for key, value in request.headers.items()
+               if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() != TIMEOUT_HEADER}
+    options = {}
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            deadline_stats['expired'] += 1
+            return DEADLINE_CONTENT, 504, {'Content-Type': 'application/json'}
+        # 子进程按剩余时间在两个方向之间停止识别
+        headers[TIMEOUT_HEADER] = f'{remaining:.3f}'
+        options['timeout'] = aiohttp.ClientTimeout(total=remaining)
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                method=request.method,
-                url=url,
-                headers=headers,
-                data=await request.body(),
-                cookies=request.cookies
-            ) as response:
-                content = await response.read()
-                return content, response.status, response.headers
+        session = get_backend_session(selected_port)
+        async with session.request(
+            method=request.method,
+            url=url,
+            headers=headers,
+            data=await request.body(),
+            cookies=request.cookies,
+            **options
+        ) as response:
+            content = await response.read()
+            return content, response.status, response.headers
+    except asyncio.TimeoutError:
+        deadline_stats['expired'] += 1
+        return DEADLINE_CONTENT, 504, {'Content-Type': 'application/json'}
     except Exception as e:
         return b'{"code": 400, "msg": "starlette.requests.ClientDisconnect"}', 500, None
-        
-        
-async def process_request_queue():
-    global request_tracker, request_limits, lock, restart_server_flag
-    while True:
-        if request_queue:
-            async with lock:
-                request, future = request_queue.popleft()
-
-            # 选择一个空闲的服务，赋值给selected_port
-            selected_port = None
-            async with lock:
-                for port, count in in_flight_requests.items():
-                    if count < max_in_flight_requests and slot_status[port] != 1:
-                        selected_port = port
-                        in_flight_requests[port] += 1
-                        break
 
+
+def expected_service_time(port: int) -> float:
+    # 还没有观测值的端口使用全局均值，避免新端口被误判为最快或最慢
+    if port in service_time_ewma:
+        return service_time_ewma[port]
+    if service_time_ewma:
+        return sum(service_time_ewma.values()) / len(service_time_ewma)
+    return 0.
+
+
+def pick_first_free(candidates):
+    return candidates[0]
+
+
+def pick_least_in_flight(candidates):
+    return min(candidates, key=lambda port: in_flight_requests[port])
+
+
+def pick_ewma(candidates):
+    # 预计完成时间 = (排在前面的请求 + 自己) * 平均服务耗时
+    return min(candidates, key=lambda port: ((in_flight_requests[port] + 1) * expected_service_time(port),
+                                             in_flight_requests[port]))
+
+
+def pick_power_of_two(candidates):
+    if len(candidates) < 2:
+        return candidates[0]
+    return pick_ewma(random.sample(candidates, 2))
+
+
+BALANCE_POLICIES = {
+    'first_free': pick_first_free,
+    'least_in_flight': pick_least_in_flight,
+    'ewma': pick_ewma,
+    'p2c': pick_power_of_two,
+}
+
+
+def select_port() -> Optional[int]:
+    '''
+    按balance_policy选择一个空闲的服务，调用方需持有lock
+    '''
+    candidates = [
+        port for port, count in in_flight_requests.items()
+        if count < max_in_flight_requests and slot_status[port] != 1
+    ]
+    if not candidates:
+        return None
+    return BALANCE_POLICIES[balance_policy](candidates)
+
+
+def record_service_time(port: int, elapsed: float):
+    previous = service_time_ewma.get(port)
+    if previous is None:
+        service_time_ewma[port] = elapsed
+    else:
+        service_time_ewma[port] = ewma_alpha * elapsed + (1 - ewma_alpha) * previous
+
+
+async def acquire_slot() -> int:
+    '''
+    阻塞直到有空闲的slot，占用并返回对应端口；slot释放时由release_slot唤醒，不再轮询
+    '''
+    async with slot_freed:
+        while True:
+            selected_port = select_port()
             if selected_port is not None:
-                logger.debug(f"请求被分发至: {selected_port}")
-                try:
-                    # track the request
-                    async with lock:
-                        request_tracker[selected_port] += 1
-                        # if request_tracker[selected_port] % 50 == 0:
-                        #     collected = gc.collect()
-                        #     logger.debug(f"一共清理了{collected}")
-                    content, status, headers = await forward_request_to_backend(request, selected_port)
-                    
-                    if status == 500:
-                        # 如果能走到这里，那大概率说明这个子进程已经OOM崩溃了，现在就选择重启
-                        if restart_server_flag:
-                            await asyncio.sleep(10)
-                            content, status, headers = await forward_request_to_backend(request, selected_port)
-                        else:
-                            logger.debug(f"重启 server:{selected_port} 中...")
-                            async with lock:
-                                slot_status[selected_port] = 1  # 赋值为1，拒绝其他请求再进入
-                                restart_server_flag = True
-                                
-                            
-                            # 等待in-flight请求都运行完，才能继续往下重启
-                            while True:
-                                if in_flight_requests[selected_port] == 1:      # 只剩下当前请求，还没处理，但是在前面已经加了，所以就是1
-                                    break
-                                else:
-                                    await asyncio.sleep(0.1)
-                                
-                            # Restart the subprocess
-                            await restart_subprocess(selected_port)
-                            await asyncio.sleep(5)
-                            
-                            logger.debug("重启成功!")
-                            
-                            async with lock:
-                                request_tracker[selected_port] = 1  # Reset count after restart
-                                slot_status[selected_port] = 0      # 允许其他请求进入
-                                restart_server_flag = False
-                                
-                            content, status, headers = await forward_request_to_backend(request, selected_port)
-
-                except aiohttp.client_exceptions.ClientOSError as e:
-                    future.set_result(Response(content=b'{"code": 400, "message": "not valid!"}'), status_code=400)
-                    # 后处理逻辑：归位
-                    async with lock:
-                        in_flight_requests[selected_port] -= 1
-                    return
-                except aiohttp.client_exceptions.ServerDisconnectedError as e:
-                    # Check if the subprocess needs to be restarted
-                    print(e)
-                    future.set_result(Response(content=b'{"code": 500, "message": "not valid!"}'), status_code=500)
-                    async with lock:
-                        in_flight_requests[selected_port] -= 1
-                    return
-
-                # 后处理逻辑：归位
-                async with lock:
-                    in_flight_requests[selected_port] -= 1
-                    
-
-                # 完成 Future，返回结果给请求者
-                # print(f"Done: {content}")
-                if headers is not None:
-                    future.set_result(Response(content=content, status_code=status, headers=dict(headers)))
-                else:
-                    future.set_result(Response(content=content, status_code=status))
-                return
+                in_flight_requests[selected_port] += 1
+                dispatch_counts[selected_port] = dispatch_counts.get(selected_port, 0) + 1
+                return selected_port
+            await slot_freed.wait()
+
+
+async def release_slot(port: int):
+    async with slot_freed:
+        if port in in_flight_requests:
+            in_flight_requests[port] -= 1
+            if port in retired_ports and not in_flight_requests[port]:
+                # 已被替换的端口上最后一个请求结束
+                retired_ports.discard(port)
+                del in_flight_requests[port]
+                del slot_status[port]
+                spare_ports.append(port)
+        recent_completions.append(time.monotonic())
+        slot_freed.notify_all()
+
+
+def drain_rate() -> float:
+    '''
+    最近drain_window秒内每秒完成的请求数
+    '''
+    now = time.monotonic()
+    while recent_completions and recent_completions[0] < now - drain_window:
+        recent_completions.popleft()
+    if not recent_completions:
+        return 0.
+    # 刚启动时窗口还没填满，按实际经过的时间计算
+    return len(recent_completions) / max(now - recent_completions[0], 1.)
+
+
+def retry_after(backlog: int) -> int:
+    '''
+    按观测到的完成速率估计积压的backlog个请求需要多久消化完
+    '''
+    rate = drain_rate()
+    if rate <= 0:
+        return max_retry_after
+    return min(max(int(math.ceil(backlog / rate)), 1), max_retry_after)
+
+
+def reject_response(status: int, msg: str, retry: int) -> Response:
+    return Response(content=json.dumps({'code': status, 'msg': msg}, ensure_ascii=False), status_code=status,
+                    media_type='application/json', headers={'Retry-After': str(retry)})
+
+
+def client_key(request: Request) -> str:
+    api_key = request.headers.get(CLIENT_KEY_HEADER)
+    if api_key:
+        return f'key:{api_key}'
+    return f'ip:{request.client.host if request.client else "unknown"}'
+
+
+def admit(client: str) -> Optional[Response]:
+    '''
+    检查是否接收新请求，拒绝时返回响应
+    '''
+    depth = request_queue.qsize()
+    if max_queue_depth and depth >= max_queue_depth:
+        admission_stats['rejected_queue_full'] += 1
+        return reject_response(503, '服务繁忙，排队请求已满', retry_after(depth - max_queue_depth + 1))
+    if max_queue_wait and depth:
+        rate = drain_rate()
+        if rate > 0 and depth / rate > max_queue_wait:
+            # 按当前速率排到时已经超过期限，直接拒绝而不是等到期限再丢弃
+            admission_stats['rejected_queue_wait'] += 1
+            return reject_response(503, '服务繁忙，预计排队时间过长', retry_after(depth - int(max_queue_wait * rate) + 1))
+    if client_quota and client_active.get(client, 0) >= client_quota:
+        admission_stats['rejected_quota'] += 1
+        # 该客户端需要等自己的一个请求完成，按平均服务耗时估计
+        service_time = sum(service_time_ewma.values()) / len(service_time_ewma) if service_time_ewma else 0.
+        retry = min(max(int(math.ceil(service_time)), 1), max_retry_after) if service_time else retry_after(depth + 1)
+        return reject_response(429, '该客户端同时处理的请求数已达上限', retry)
+    return None
+
+
+def record_queue_wait(wait: float):
+    queue_wait_stats['count'] += 1
+    queue_wait_stats['total'] += wait
+    queue_wait_stats['last'] = wait
+    queue_wait_stats['max'] = max(queue_wait_stats['max'], wait)
+    recent_queue_waits.append(wait)
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def set_future_response(future: asyncio.Future, content: bytes, status: int, headers=None, queue_wait: float = 0.):
+    # 客户端已经断开时future会被取消，此时直接丢弃结果
+    if future.done():
+        return
+    headers = dict(headers) if headers is not None else {}
+    headers['X-Queue-Wait-Ms'] = str(round(queue_wait * 1000, 2))
+    future.set_result(Response(content=content, status_code=status, headers=headers))
+
+
+async def handle_request(request: Request, future: asyncio.Future, selected_port: int, queue_wait: float,
+                         deadline: Optional[float] = None):
+    try:
+        # track the request
+        async with lock:
+            request_tracker[selected_port] += 1
+
+        forward_start = time.monotonic()
+        forward = asyncio.ensure_future(forward_request_to_backend(request, selected_port, deadline))
+        # 没有人再等待结果时中止转发，子进程检测到连接断开后停止识别
+        future.add_done_callback(lambda done: forward.cancel() if done.cancelled() else None)
+        content, status, headers = await forward
+        if status == 200:
+            # 出错的请求返回很快，计入EWMA会让故障的子进程看起来最快
+            record_service_time(selected_port, time.monotonic() - forward_start)
+    except asyncio.CancelledError:
+        content, status, headers = b'', 499, None
+    except aiohttp.client_exceptions.ClientOSError as e:
+        content, status, headers = b'{"code": 400, "message": "not valid!"}', 400, None
+    except aiohttp.client_exceptions.ServerDisconnectedError as e:
+        content, status, headers = b'{"code": 500, "message": "not valid!"}', 500, None
+    except Exception as e:
+        logger.exception(e)
+        content, status, headers = b'{"code": 500, "message": "gateway error"}', 500, None
+    finally:
+        # 后处理逻辑：归位
+        await release_slot(selected_port)
+
+    # 完成 Future，返回结果给请求者
+    set_future_response(future, content, status, headers, queue_wait)
+
+
+def shed_expired(future: asyncio.Future, enqueued_at: float, deadline: Optional[float] = None) -> bool:
+    '''
+    已过期限的请求返回504，排队超过max_queue_wait的请求返回503，客户端多半已经超时，不再占用子进程
+    '''
+    now = time.monotonic()
+    queue_wait = now - enqueued_at
+    if deadline is not None and now >= deadline:
+        deadline_stats['expired_in_queue'] += 1
+        set_future_response(future, DEADLINE_CONTENT, 504, {'Content-Type': 'application/json'}, queue_wait)
+        return True
+    if not max_queue_wait or queue_wait <= max_queue_wait:
+        return False
+    admission_stats['shed_deadline'] += 1
+    retry = retry_after(request_queue.qsize() + 1)
+    set_future_response(future, json.dumps({'code': 503, 'msg': '排队超时'}, ensure_ascii=False).encode(), 503,
+                        {'Retry-After': str(retry), 'Content-Type': 'application/json'}, queue_wait)
+    return True
+
+
+async def next_request(timeout: Optional[float] = None):
+    '''
+    先取凑批时放回的请求，再从队列取
+    :param timeout: 最多等待的秒数，0表示不等待；超时返回None
+    '''
+    if deferred_requests:
+        return deferred_requests.popleft()
+    if timeout is None:
+        return await request_queue.get()
+    if timeout <= 0:
+        try:
+            return request_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+    try:
+        return await asyncio.wait_for(request_queue.get(), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+
+def micro_batch_item(fields):
+    '''
+    在入队前由已解析的字段得到合并所需的内容，dispatcher不再解析请求体
+    :param fields: read_cache_fields / image_fields 得到的已排序字段
+    :return: (params, ('file', data))；只有一张不超过micro_batch_max_kb的图片（file字段）时才能合并，否则返回None
+    '''
+    if micro_batch_max <= 1 or fields is None:
+        return None
+    files = [value for name, value in fields if name == 'file']
+    if len(files) != 1 or len(files[0]) > micro_batch_max_kb * 1024 or any(name == 'img' for name, _ in fields):
+        return None
+    return [(name, value) for name, value in fields if name != 'file'], ('file', files[0])
+
+
+async def collect_micro_batch(first, item):
+    '''
+    以first为首凑一批：先取已经在排队的请求，不足micro_batch_max时最多再等窗口剩余的时间；
+    遇到参数不同或不能合并的请求就停止，该请求放回队首，保持FIFO
+    :return: [(queued, image)]，queued为队列中的 (request, future, enqueued_at, deadline, item)
+    '''
+    params = item[0]
+    group = [(first, item[1])]
+    window_end = time.monotonic() + micro_batch_window_ms / 1000.
+    while len(group) < micro_batch_max:
+        queued = await next_request(max(window_end - time.monotonic(), 0))
+        if queued is None:
+            break
+        request, future, enqueued_at, deadline, item = queued
+        if future.done() or shed_expired(future, enqueued_at, deadline):
+            continue
+        if item is None or item[0] != params:
+            deferred_requests.appendleft(queued)
+            break
+        group.append((queued, item[1]))
+    return group
+
+
+def record_micro_batch(size: int):
+    micro_batch_stats['batches'] += 1
+    micro_batch_stats['items'] += size
+    micro_batch_stats['max_size'] = max(micro_batch_stats['max_size'], size)
+    micro_batch_stats['sizes'][size] = micro_batch_stats['sizes'].get(size, 0) + 1
+
+
+async def forward_batch_to_backend(group, params, selected_port: int, queue_waits):
+    '''
+    一次调用子进程的 /api/tr-run-batch，按返回的NDJSON完成各请求的future
+    unpack=0让子进程不解压上传的文件（小于上限的zip也可能作为单张请求上传），结果与group一一对应
+    :return: 没有拿到结果的请求使用的 (content, status, headers)，全部完成时为None
+    '''
+    url = f"http://localhost:{selected_port}/api/tr-run-batch?unpack=0"
+    body, content_type = encode_multipart(params, [image for _, image in group])
+    headers = {'content-type': content_type}
+    options = {}
+    # 子进程按最晚的期限停止，期限更早的请求由各自的客户端超时
+    deadlines = [queued[3] for queued, _ in group]
+    if all(deadline is not None for deadline in deadlines):
+        remaining = max(deadlines) - time.monotonic()
+        if remaining <= 0:
+            deadline_stats['expired'] += len(group)
+            return DEADLINE_CONTENT, 504, {'Content-Type': 'application/json'}
+        headers[TIMEOUT_HEADER] = f'{remaining:.3f}'
+        options['timeout'] = aiohttp.ClientTimeout(total=remaining)
+
+    item_headers = {'Content-Type': 'application/json', 'X-Micro-Batch': str(len(group))}
+    try:
+        session = get_backend_session(selected_port)
+        async with session.post(url, headers=headers, data=body, **options) as response:
+            if response.status != 200:
+                # 单张图片的问题在结果行里返回，整个请求的错误只来自同一批共用的参数，对每个请求都成立
+                return await response.read(), response.status, response.headers
+            content = await response.read()
+    except asyncio.TimeoutError:
+        deadline_stats['expired'] += 1
+        return DEADLINE_CONTENT, 504, {'Content-Type': 'application/json'}
+    # 先校验整批结果再完成future，index与上传顺序对不上时不把任何结果交给客户端
+    try:
+        lines = batch.parse_result_lines(content, len(group))
+    except batch.BatchError as e:
+        logger.error(f'micro-batch result from port {selected_port} rejected: {e}')
+        return b'{"code": 500, "message": "batch result mismatch"}', 500, None
+    for (queued, _), line, queue_wait in zip(group, lines, queue_waits):
+        set_future_response(queued[1], json.dumps(line['result'], ensure_ascii=False).encode(), line['status'],
+                            item_headers, queue_wait)
+    return None
+
+
+async def handle_micro_batch(group, params, selected_port: int, queue_waits):
+    futures = [queued[1] for queued, _ in group]
+    try:
+        async with lock:
+            request_tracker[selected_port] += len(group)
+
+        forward_start = time.monotonic()
+        forward = asyncio.ensure_future(forward_batch_to_backend(group, params, selected_port, queue_waits))
+        # 整批都没有人等待时才中止转发
+        for future in futures:
+            future.add_done_callback(
+                lambda done: forward.cancel() if all(future.cancelled() for future in futures) else None)
+        fallback = await forward
+        if fallback is None:
+            # EWMA按单张请求的耗时记录，与未合并的请求可比
+            record_service_time(selected_port, (time.monotonic() - forward_start) / len(group))
+    except asyncio.CancelledError:
+        fallback = b'', 499, None
+    except (aiohttp.client_exceptions.ClientOSError, aiohttp.client_exceptions.ServerDisconnectedError) as e:
+        fallback = b'{"code": 500, "message": "not valid!"}', 500, None
+    except Exception as e:
+        logger.exception(e)
+        fallback = b'{"code": 500, "message": "gateway error"}', 500, None
+    finally:
+        await release_slot(selected_port)
+
+    if fallback is not None:
+        for future, queue_wait in zip(futures, queue_waits):
+            set_future_response(future, *fallback, queue_wait)
+
+
+async def dispatch_request_queue():
+    '''
+    唯一的调度协程：按FIFO顺序取出请求，阻塞等待空闲slot后交给handle_request执行；
+    开启微批时，拿到slot后再凑一批交给handle_micro_batch
+    '''
+    while True:
+        request, future, enqueued_at, deadline, item = await next_request()
+        if future.done():
+            # 排队期间客户端已经断开
+            continue
+        if shed_expired(future, enqueued_at, deadline):
+            continue
+
+        selected_port = await acquire_slot()
+        if future.done() or shed_expired(future, enqueued_at, deadline):
+            await release_slot(selected_port)
+            continue
+
+        if item is not None and micro_batch_max > 1:
+            group = await collect_micro_batch((request, future, enqueued_at, deadline, item), item)
+            record_micro_batch(len(group))
+            if len(group) > 1:
+                now = time.monotonic()
+                queue_waits = [now - queued[2] for queued, _ in group]
+                for queue_wait in queue_waits:
+                    record_queue_wait(queue_wait)
+                logger.debug(f"{len(group)} 个请求合并分发至: {selected_port}")
+                task = asyncio.create_task(handle_micro_batch(group, item[0], selected_port, queue_waits))
+                handler_tasks.add(task)
+                task.add_done_callback(handler_tasks.discard)
+                continue
+
+        queue_wait = time.monotonic() - enqueued_at
+        record_queue_wait(queue_wait)
+        logger.debug(f"请求被分发至: {selected_port}, 排队 {queue_wait * 1000:.1f}ms")
+        task = asyncio.create_task(handle_request(request, future, selected_port, queue_wait, deadline))
+        handler_tasks.add(task)
+        task.add_done_callback(handler_tasks.discard)
+
+
+async def read_cache_fields(request: Request):
+    '''
+    读取图片内容和影响结果的参数，用于计算缓存键
+    :return: (fields, bypass)
+    '''
+    # 先读取body，表单解析后转发时仍能拿到原始body
+    await request.body()
+    bypass = 'no-cache' in request.headers.get('cache-control', '')
+    items = list(request.query_params.multi_items())
+    form = await request.form()
+    try:
+        items += list(form.multi_items())
+        fields = []
+        for name, value in sorted(items, key=lambda item: item[0]):
+            if name == CACHE_BYPASS_FIELD:
+                bypass = bypass or value not in ('', '0')
+                continue
+            if isinstance(value, str):
+                fields.append((name, value.encode()))
             else:
-                # 如果没有空闲服务，则请求重新入队
-                async with lock:
-                    request_queue.appendleft((request, future))
-        
-        await asyncio.sleep(0.1)  # 小的等待时间，避免无意义的空循环
+                # 上传的文件只取内容，文件名不影响结果
+                fields.append((name, await value.read()))
+    finally:
+        await form.close()
+    return fields, bypass
+
+
+class Flight:
+    '''
+    某个缓存键上正在进行的一次后端调用；发起者(leader)断开后，只要还有等待者就继续执行
+    '''
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 1
+
+
+def store_result(key: str, future: asyncio.Future):
+    if cache is None or future.cancelled() or future.result().status_code != 200:
+        return
+    response = future.result()
+    asyncio.get_running_loop().run_in_executor(None, cache.put, key, response.body,
+                                               response.headers.get('content-type'))
+
+
+def submit_request(request: Request, key: Optional[str] = None, deadline: Optional[float] = None,
+                   item: Optional[tuple] = None) -> asyncio.Future:
+    '''
+    将请求加入队列，由dispatcher处理；返回的future与发起请求的客户端无关，成功的结果写入缓存
+    '''
+    future = asyncio.get_running_loop().create_future()
+    if key is not None:
+        future.add_done_callback(lambda done: store_result(key, done))
+    request_queue.put_nowait((request, future, time.monotonic(), deadline, item))
+    return future
+
+
+def copy_response(response: Response, **headers) -> Response:
+    # 同一个结果返回给多个客户端，每个客户端一个独立的Response
+    merged = {name: value for name, value in response.headers.items() if name != 'content-length'}
+    merged.update(headers)
+    return Response(content=response.body, status_code=response.status_code, headers=merged)
+
+
+async def await_flight(request: Request, key: str, deadline: Optional[float] = None,
+                       item: Optional[tuple] = None) -> Tuple[Response, bool]:
+    '''
+    加入或发起key上的后端调用；后端调用使用发起者的期限
+    :return: (response, 是否为leader)
+    '''
+    while True:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight(submit_request(request, key, deadline, item))
+            flights[key] = flight
+            # 先于等待者被唤醒执行，等待者醒来时flight已经移除
+            flight.future.add_done_callback(
+                lambda done, flight=flight: flights.pop(key) if flights.get(key) is flight else None)
+            single_flight_stats['leaders'] += 1
+        else:
+            flight.waiters += 1
+            single_flight_stats['coalesced'] += 1
+
+        try:
+            response = await asyncio.shield(flight.future)
+        except asyncio.CancelledError:
+            # 客户端断开；没有人再等待时取消排队中的请求，dispatcher会跳过它
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.future.done():
+                flight.future.cancel()
+                # 立即移除，之后到达的相同请求不能加入已取消的调用
+                if flights.get(key) is flight:
+                    flights.pop(key)
+            raise
+
+        if response.status_code >= 500 and 'retry-after' not in response.headers and not leader:
+            # leader的调用失败，由等待者重新发起，而不是把失败结果分给所有人；
+            # 因过载被拒绝（带Retry-After）时重新发起只会加重负载，直接共享
+            single_flight_stats['handoffs'] += 1
+            continue
+        return response, leader
 
 
 @app.post("/api/tr-run")
 async def tr_serve(request: Request):
-    # 创建一个future对象
-    future = asyncio.Future()
-    
-    # 将请求加入队列
-    async with lock:
-        request_queue.append((request, future))
-        
-    await process_request_queue()
+    # 读取请求体之前先做准入检查
+    client = client_key(request)
+    rejected = admit(client)
+    if rejected is not None:
+        return rejected
+    deadline, error = parse_deadline(request)
+    if error is not None:
+        return error
+
+    client_active[client] = client_active.get(client, 0) + 1
+    try:
+        return await await_with_deadline(request, serve_request(request, deadline), deadline)
+    finally:
+        client_active[client] -= 1
+        if not client_active[client]:
+            del client_active[client]
+
+
+def parse_deadline(request: Request) -> Tuple[Optional[float], Optional[Response]]:
+    '''
+    :return: (deadline, error)，期限格式错误时error为400响应
+    '''
+    timeout = request.headers.get(TIMEOUT_HEADER) or default_request_timeout
+    try:
+        timeout = float(timeout)
+        if not math.isfinite(timeout):
+            raise ValueError(timeout)
+    except ValueError:
+        return None, Response(content=json.dumps({'code': 400, 'msg': 'X-Request-Timeout只能是秒数'}, ensure_ascii=False),
+                              status_code=400, media_type='application/json')
+    return (time.monotonic() + timeout if timeout > 0 else None), None
+
+
+async def wait_disconnected(request: Request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(disconnect_poll_interval)
+
+
+async def await_with_deadline(request: Request, coro, deadline: Optional[float]) -> Response:
+    '''
+    等待coro的结果，同时监视期限和客户端断开；任一发生时取消coro，
+    取消会传到排队中的请求、对子进程的转发，最终让子进程停止识别
+    '''
+    # is_disconnected会读取ASGI消息，必须先把body读完，否则会吞掉body
+    await request.body()
+    serve = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_disconnected(request))
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    try:
+        done, _ = await asyncio.wait({serve, watcher}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        serve.cancel()
+        raise
+    finally:
+        watcher.cancel()
+
+    if serve in done:
+        return serve.result()
+    serve.cancel()
+    if watcher in done:
+        deadline_stats['disconnected'] += 1
+        return Response(status_code=499)
+    deadline_stats['expired'] += 1
+    return Response(content=DEADLINE_CONTENT, status_code=504, media_type='application/json')
+
+
+async def serve_request(request: Request, deadline: Optional[float] = None) -> Response:
+    fields, bypass = None, False
+    if cache is not None or single_flight or micro_batch_max > 1:
+        fields, bypass = await read_cache_fields(request)
+    return await serve_fields(request, fields, bypass, deadline)
+
 
-    # 立即处理队列
-    response = await future
-    return response
+async def serve_fields(request, fields, bypass: bool, deadline: Optional[float] = None) -> Response:
+    '''
+    :param fields: read_cache_fields 得到的字段，None表示不使用缓存和合并
+    '''
+    loop = asyncio.get_running_loop()
+    key, cache_status = None, None
+    item = micro_batch_item(fields)
+    if fields is not None and (cache is not None or single_flight):
+        # 哈希和SQLite读写都放到线程池，不阻塞事件循环
+        key = await loop.run_in_executor(None, result_cache.make_key, fields)
+    if cache is not None:
+        if bypass:
+            cache.bypasses += 1
+            cache_status = 'BYPASS'
+        else:
+            cached = await loop.run_in_executor(None, cache.get, key)
+            if cached is not None:
+                content, content_type = cached
+                return Response(content=content, status_code=200, media_type=content_type,
+                                headers={'X-Cache': 'HIT'})
+            cache_status = 'MISS'
+
+    headers = {'X-Cache': cache_status} if cache_status is not None else {}
+    if not single_flight:
+        response = await submit_request(request, key if cache is not None else None, deadline, item)
+        return copy_response(response, **headers)
+
+    response, leader = await await_flight(request, key, deadline, item)
+    headers['X-Single-Flight'] = 'LEADER' if leader else 'JOINED'
+    return copy_response(response, **headers)
+
+
+def encode_multipart(params, images):
+    '''
+    :param params: [(name, bytes)]
+    :param images: [(filename, bytes)]，都放在file字段
+    :return: (body, content_type)
+    '''
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'.encode() + value + b'\r\n'
+             for key, value in params]
+    for name, data in images:
+        filename = name.rsplit('/', 1)[-1].replace('"', '').replace('\r', '').replace('\n', '')
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class ImageRequest:
+    '''
+    批量请求中的一张图片，按单张请求的格式重新编码成multipart，只提供转发时用到的Request接口
+    '''
+    method = 'POST'
+
+    def __init__(self, name: str, data: bytes, params, request: Optional[Request] = None):
+        self._body, content_type = encode_multipart(params, [(name, data)])
+        self.headers = {key: value for key, value in request.headers.items()
+                        if key not in ('content-type', 'content-length')} if request is not None else {}
+        self.headers['content-type'] = content_type
+        self.cookies = request.cookies if request is not None else None
+
+    async def body(self) -> bytes:
+        return self._body
+
+
+async def read_batch(request: Request):
+    '''
+    :return: (images, params, bypass)，params为应用到每张图片的参数 [(name, bytes)]
+    :raise batch.BatchError:
+    '''
+    bypass = 'no-cache' in request.headers.get('cache-control', '')
+    uploads, params = [], []
+    form = await request.form()
+    try:
+        for name, value in list(request.query_params.multi_items()) + list(form.multi_items()):
+            if not isinstance(value, str):
+                uploads.append((value.filename, await value.read()))
+            elif name == CACHE_BYPASS_FIELD:
+                bypass = bypass or value not in ('', '0')
+            else:
+                params.append((name, value.encode()))
+    finally:
+        await form.close()
+    # 解压放到线程池
+    images = await asyncio.get_running_loop().run_in_executor(None, batch.expand_uploads, uploads)
+    return images, params, bypass
+
+
+def batch_result(content: bytes):
+    try:
+        return json.loads(content)
+    except ValueError:
+        return content.decode('utf-8', 'replace')
+
+
+def image_fields(data: bytes, params):
+    # 与read_cache_fields得到的字段一致，批量和任务中的图片与单张请求共用缓存
+    if cache is None and not single_flight and micro_batch_max <= 1:
+        return None
+    return sorted(params + [('file', data)], key=lambda item: item[0])
+
+
+async def stream_batch(request: Request, images, params, bypass: bool, deadline: Optional[float], client: str):
+    '''
+    每张图片按单张请求处理（缓存、合并、排队、期限都一样），同一批最多batch_concurrency张同时进入队列，
+    避免一个大批量把其他客户端的请求排到最后
+    '''
+    start_time = time.monotonic()
+    limit = asyncio.Semaphore(batch_concurrency or len(ports) * max_in_flight_requests)
+
+    async def run(index: int, name: str, data: bytes) -> str:
+        async with limit:
+            response = await serve_fields(ImageRequest(name, data, params, request), image_fields(data, params),
+                                          bypass, deadline)
+        return batch.result_line(index, name, response.status_code, batch_result(response.body),
+                                 time.monotonic() - start_time)
+
+    batch_stats['batches'] += 1
+    batch_stats['images'] += len(images)
+    batch_stats['active'] += 1
+    tasks = []
+    try:
+        # 在生成器里计入配额：客户端在响应开始前断开时生成器不会执行，finally也不会执行
+        client_active[client] = client_active.get(client, 0) + 1
+        tasks = [asyncio.ensure_future(run(index, name, data)) for index, (name, data) in enumerate(images)]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # 客户端断开时取消剩下的图片，取消会传到排队中的请求和子进程
+        for task in tasks:
+            task.cancel()
+        batch_stats['active'] -= 1
+        client_active[client] -= 1
+        if not client_active[client]:
+            del client_active[client]
+
+
+@app.post("/api/tr-run-batch")
+async def tr_serve_batch(request: Request):
+    '''
+    一次上传多张图片（多个file字段，或一个zip/tar压缩包），其余表单字段应用到每张图片，
+    按完成顺序逐行返回NDJSON：{"index", "name", "status", "elapsed_ms", "result"}
+    X-Request-Timeout 是整批的期限；整批只占用一次准入检查和一个客户端配额
+    '''
+    client = client_key(request)
+    rejected = admit(client)
+    if rejected is not None:
+        return rejected
+    deadline, error = parse_deadline(request)
+    if error is not None:
+        return error
+    try:
+        images, params, bypass = await read_batch(request)
+    except batch.BatchError as e:
+        return Response(content=json.dumps({'code': 400, 'msg': str(e)}, ensure_ascii=False),
+                        status_code=400, media_type='application/json')
+    if not images:
+        return Response(content=json.dumps({'code': 400, 'msg': '没有传入图片'}, ensure_ascii=False),
+                        status_code=400, media_type='application/json')
+
+    return StreamingResponse(stream_batch(request, images, params, bypass, deadline, client),
+                             media_type='application/x-ndjson')
+
+
+async def run_jobs():
+    '''
+    任务协程：领取一个条目，按单张请求处理（缓存、合并、排队都一样），记录结果；
+    job_concurrency个协程同时执行，子进程按自己的速度消化，不会一次占满队列
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        item = None
+        try:
+            item = await loop.run_in_executor(None, job_store.claim)
+            if item is None:
+                job_wakeup.clear()
+                try:
+                    await asyncio.wait_for(job_wakeup.wait(), job_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, index, name, data, params, bypass, attempts = item
+            start_time = time.monotonic()
+            response = await serve_fields(ImageRequest(name, data, params), image_fields(data, params), bypass)
+            if (response.status_code >= 500 or response.status_code == 499) and attempts < job_max_attempts:
+                # 过载、子进程回收中或故障，退避后重新排队
+                await asyncio.sleep(min(2 ** attempts, max_retry_after))
+                await loop.run_in_executor(None, job_store.retry, job_id, index)
+                continue
+            job = await loop.run_in_executor(None, job_store.finish, job_id, index, response.status_code,
+                                             response.body, time.monotonic() - start_time)
+            item = None
+            if job is not None and job['webhook']:
+                schedule_webhook(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(e)
+            if item is not None:
+                # 领取的条目不能停在running，否则要等网关重启才会重新排队
+                await fail_job_item(item)
+            await asyncio.sleep(job_poll_interval)
+
+
+async def fail_job_item(item):
+    '''
+    处理条目时网关出错：还有尝试次数时重新排队，否则记为失败
+    '''
+    loop = asyncio.get_running_loop()
+    job_id, index, _, _, _, _, attempts = item
+    try:
+        if attempts < job_max_attempts:
+            await loop.run_in_executor(None, job_store.retry, job_id, index)
+            return
+        job = await loop.run_in_executor(None, job_store.finish, job_id, index, 500,
+                                         b'{"code": 500, "message": "gateway error"}', 0.)
+        if job is not None and job['webhook']:
+            schedule_webhook(job_id)
+    except Exception as e:
+        logger.exception(e)
+
+
+def job_summary(job: dict) -> dict:
+    summary = {key: value for key, value in job.items() if key != 'webhook'}
+    summary['status_url'] = f"/api/jobs/{job['job_id']}"
+    summary['result_url'] = f"/api/jobs/{job['job_id']}/result"
+    return summary
+
+
+async def deliver_webhook(job_id: str):
+    '''
+    任务完成后把状态POST到提交时给出的webhook，失败时退避重试；送达状态记录在任务中，重启后继续投递
+    '''
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(None, job_store.get, job_id)
+    if job is None or not job['webhook']:
+        return
+    for attempt in range(job_webhook_attempts):
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+                async with session.post(job['webhook'], json=job_summary(job)) as response:
+                    if response.status < 300:
+                        await loop.run_in_executor(None, job_store.set_webhook_state, job_id, 'delivered')
+                        return
+                    logger.warning(f"webhook {job_id} 返回 {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"webhook {job_id} 失败: {e!r}")
+        await asyncio.sleep(min(2 ** attempt, max_retry_after))
+    await loop.run_in_executor(None, job_store.set_webhook_state, job_id, 'failed')
+
+
+def schedule_webhook(job_id: str):
+    task = asyncio.create_task(deliver_webhook(job_id))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+
+
+async def purge_jobs():
+    while True:
+        purged = await asyncio.get_running_loop().run_in_executor(None, job_store.purge, job_retention)
+        if purged:
+            logger.info(f"删除 {purged} 个过期任务")
+        await asyncio.sleep(3600)
+
+
+async def start_jobs():
+    loop = asyncio.get_running_loop()
+    recovered = await loop.run_in_executor(None, job_store.recover)
+    if recovered:
+        logger.info(f"{recovered} 个未完成的任务条目重新排队")
+    for job_id in await loop.run_in_executor(None, job_store.pending_webhooks):
+        schedule_webhook(job_id)
+    job_tasks.extend(asyncio.create_task(run_jobs())
+                     for _ in range(job_concurrency or len(ports) * max_in_flight_requests))
+    if job_retention:
+        job_tasks.append(asyncio.create_task(purge_jobs()))
+
+
+def json_response(status: int, content: dict) -> Response:
+    return Response(content=json.dumps(content, ensure_ascii=False), status_code=status, media_type='application/json')
+
+
+@app.post("/api/jobs")
+async def submit_job(request: Request):
+    '''
+    提交异步任务：表单与 /api/tr-run-batch 相同，可选的webhook字段为任务完成时回调的URL；
+    立即返回202和任务id，之后通过 /api/jobs/{job_id} 查询状态、/api/jobs/{job_id}/result 获取结果
+    '''
+    if job_store is None:
+        return json_response(404, {'code': 404, 'msg': '未开启异步任务'})
+    loop = asyncio.get_running_loop()
+    if job_max_pending:
+        pending = await loop.run_in_executor(None, job_store.pending)
+        if pending >= job_max_pending:
+            admission_stats['rejected_queue_full'] += 1
+            return reject_response(503, '服务繁忙，未完成的任务已满', retry_after(pending - job_max_pending + 1))
+    try:
+        images, params, bypass = await read_batch(request)
+    except batch.BatchError as e:
+        return json_response(400, {'code': 400, 'msg': str(e)})
+    if not images:
+        return json_response(400, {'code': 400, 'msg': '没有传入图片'})
+    webhook = None
+    for name, value in params:
+        if name == 'webhook':
+            webhook = value.decode()
+    params = [(name, value) for name, value in params if name != 'webhook']
+    if webhook is not None and not webhook.startswith(('http://', 'https://')):
+        return json_response(400, {'code': 400, 'msg': 'webhook只能是http(s) URL'})
+
+    job_id = await loop.run_in_executor(None, job_store.submit, images, params, bypass, webhook)
+    job_wakeup.set()
+    job = await loop.run_in_executor(None, job_store.get, job_id)
+    return json_response(202, {'code': 202, 'msg': '已提交', 'data': job_summary(job)})
+
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.get_running_loop().run_in_executor(None, job_store.get, job_id) if job_store else None
+    if job is None:
+        return json_response(404, {'code': 404, 'msg': '任务不存在'})
+    return json_response(200, {'code': 200, 'msg': '成功', 'data': job_summary(job)})
+
+
+@app.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    '''
+    返回已完成图片的结果；任务未完成时状态码为202，结果只包含已完成的部分
+    '''
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(None, job_store.get, job_id) if job_store else None
+    if job is None:
+        return json_response(404, {'code': 404, 'msg': '任务不存在'})
+    results = [{'index': index, 'name': name, 'status': status, 'elapsed_ms': round(elapsed * 1000, 2),
+                'result': batch_result(content)}
+               for index, name, status, content, elapsed in await loop.run_in_executor(None, job_store.results, job_id)]
+    status = 200 if job['status'] == jobs.DONE else 202
+    return json_response(status, {'code': status, 'msg': job['status'], 'data': dict(job_summary(job), results=results)})
+
+
+@app.get("/api/gateway-stats")
+async def gateway_stats():
+    # SQLite是同步调用，放到线程池里执行，且不占用lock
+    loop = asyncio.get_running_loop()
+    cache_stats = await loop.run_in_executor(None, cache.stats) if cache is not None else None
+    job_stats = await loop.run_in_executor(None, job_store.stats) if job_store is not None else None
+    async with lock:
+        return {
+            'queue_depth': request_queue.qsize(),
+            'in_flight_requests': dict(in_flight_requests),
+            'slot_status': dict(slot_status),
+            'balance_policy': balance_policy,
+            'dispatch_counts': dict(dispatch_counts),
+            'service_time_ewma_ms': {port: round(value * 1000, 2) for port, value in service_time_ewma.items()},
+            'workers': {
+                port: {
+                    'pid': processes[port].pid if port in processes else None,
+                    'rss_mb': round(worker_rss[port] / 1024 / 1024, 1) if port in worker_rss else None,
+                    'requests_since_start': request_tracker.get(port, 0),
+                    'recycled': recycle_counts.get(port, 0),
+                }
+                for port in in_flight_requests
+            },
+            'max_worker_rss_mb': max_worker_rss_mb,
+            'zygote': {
+                'enabled': bool(zygote_mode),
+                'pid': zygote_process.pid if zygote_process is not None else None,
+            },
+            'standby_ports': list(standby_ports),
+            'spare_ports': list(spare_ports),
+            'connection_pools': {
+                port: {'limit': pool_connection_limit, 'closed': session.closed}
+                for port, session in backend_sessions.items()
+            },
+            'queue_wait': {
+                'count': queue_wait_stats['count'],
+                'avg_ms': round(queue_wait_stats['total'] / max(queue_wait_stats['count'], 1) * 1000, 2),
+                'max_ms': round(queue_wait_stats['max'] * 1000, 2),
+                'last_ms': round(queue_wait_stats['last'] * 1000, 2),
+                'p50_ms': round(percentile(recent_queue_waits, 0.5) * 1000, 2),
+                'p99_ms': round(percentile(recent_queue_waits, 0.99) * 1000, 2),
+            },
+            'cache': cache_stats,
+            'single_flight': dict(single_flight_stats, enabled=bool(single_flight), in_flight_keys=len(flights)),
+            'admission': dict(admission_stats, max_queue_depth=max_queue_depth, max_queue_wait=max_queue_wait,
+                              client_quota=client_quota, active_clients=len(client_active),
+                              drain_rate=round(drain_rate(), 3)),
+            'deadlines': dict(deadline_stats, default_request_timeout=default_request_timeout),
+            'micro_batch': dict(micro_batch_stats, enabled=micro_batch_max > 1, max=micro_batch_max,
+                                window_ms=micro_batch_window_ms, max_kb=micro_batch_max_kb,
+                                avg_size=round(micro_batch_stats['items'] / max(micro_batch_stats['batches'], 1), 2)),
+            'batch': dict(batch_stats, concurrency=batch_concurrency or len(ports) * max_in_flight_requests),
+            'jobs': dict(job_stats, concurrency=job_concurrency or len(ports) * max_in_flight_requests,
+                         max_attempts=job_max_attempts) if job_stats is not None else None,
+        }
 
 
 if __name__ == '__main__':
-    uvicorn.run(app, host='0.0.0.0', port=6006)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Run OCR gateway")
+    parser.add_argument('--port', type=int, default=6006, help='Port to run the gateway on')
+    parser.add_argument('--workers', type=int, default=len(ports), help='OCR子进程数量')
+    parser.add_argument('--worker_sessions', type=int, default=worker_sessions,
+                        help='每个子进程内的native session数量；可以用更少的进程、更多的session共享一份模型')
+    parser.add_argument('--max_in_flight', type=int, default=max_in_flight_requests, help='每个子进程同时处理的最大请求数')
+    parser.add_argument('--balance_policy', type=str, default=balance_policy, choices=sorted(BALANCE_POLICIES),
+                        help='子进程负载均衡策略')
+    parser.add_argument('--max_worker_rss_mb', type=int, default=max_worker_rss_mb,
+                        help='子进程RSS超过该值（MB）时优雅回收，0表示不回收')
+    parser.add_argument('--rss_sample_interval', type=float, default=rss_sample_interval, help='RSS采样间隔（秒）')
+    parser.add_argument('--warm_standby', type=int, default=warm_standby, help='是否常驻一个热备子进程，1为开启')
+    parser.add_argument('--spare_ports', type=int, nargs='*', default=None,
+                        help='用于零停机替换子进程的备用端口')
+    parser.add_argument('--zygote', type=int, default=zygote_mode,
+                        help='是否由预加载模块的zygote进程fork子进程，1为开启')
+    parser.add_argument('--zygote_preload_models', type=int, default=zygote_preload_models,
+                        help='zygote是否在fork前加载模型，1为开启；需确认native库的推理线程在fork后可用')
+    parser.add_argument('--pool_limit', type=int, default=None, help='每个子进程连接池的最大连接数，默认与max_in_flight一致')
+    parser.add_argument('--max_queue_depth', type=int, default=max_queue_depth, help='排队请求数上限，超过时返回503，0表示不限')
+    parser.add_argument('--max_queue_wait', type=float, default=max_queue_wait,
+                        help='排队耗时上限（秒），超过的请求返回503，0表示不限')
+    parser.add_argument('--client_quota', type=int, default=client_quota,
+                        help='每个客户端（X-API-Key或IP）同时处理的请求数上限，超过时返回429，0表示不限')
+    parser.add_argument('--request_timeout', type=float, default=default_request_timeout,
+                        help='请求没有X-Request-Timeout头时的默认期限（秒），0表示不限')
+    parser.add_argument('--micro_batch_max', type=int, default=micro_batch_max,
+                        help='微批：每次转发最多合并的请求数，1表示不合并')
+    parser.add_argument('--micro_batch_window_ms', type=float, default=micro_batch_window_ms,
+                        help='微批：拿到slot后凑批最多等待的毫秒数，0表示只合并已经在排队的请求')
+    parser.add_argument('--micro_batch_max_kb', type=int, default=micro_batch_max_kb,
+                        help='微批：图片超过该大小（KB）的请求不合并')
+    parser.add_argument('--batch_concurrency', type=int, default=batch_concurrency,
+                        help='每个批量请求同时排队/处理的图片数，0表示与总slot数一致')
+    parser.add_argument('--jobs', type=int, default=jobs_enabled, help='是否开启异步任务接口 /api/jobs，1为开启')
+    parser.add_argument('--job_path', type=str, default=job_path, help='异步任务队列的SQLite文件路径')
+    parser.add_argument('--job_concurrency', type=int, default=job_concurrency,
+                        help='同时排队/处理的任务图片数，0表示与总slot数一致')
+    parser.add_argument('--job_max_attempts', type=int, default=job_max_attempts, help='任务中每张图片的最多尝试次数')
+    parser.add_argument('--job_max_pending', type=int, default=job_max_pending,
+                        help='未完成的任务图片数上限，超过时拒绝提交，0表示不限')
+    parser.add_argument('--job_retention', type=float, default=job_retention,
+                        help='完成的任务保留时间（秒），0表示一直保留')
+    parser.add_argument('--cache', type=int, default=cache_enabled, help='是否缓存识别结果，1为开启')
+    parser.add_argument('--single_flight', type=int, default=single_flight,
+                        help='是否合并相同图片和参数的并发请求，1为开启')
+    parser.add_argument('--cache_path', type=str, default=cache_path, help='结果缓存的SQLite文件路径')
+    parser.add_argument('--cache_max_entries', type=int, default=cache_max_entries, help='结果缓存的最大条目数，0表示不限')
+    parser.add_argument('--cache_max_mb', type=int, default=cache_max_mb, help='结果缓存的最大容量（MB），0表示不限')
+    parser.add_argument('--cache_ttl', type=float, default=cache_ttl, help='缓存结果的有效期（秒），0表示不过期')
+    args = parser.parse_args()
+
+    ports = [8000 + i for i in range(1, args.workers + 1)]
+    worker_sessions = args.worker_sessions
+    max_in_flight_requests = args.max_in_flight
+    balance_policy = args.balance_policy
+    max_worker_rss_mb = args.max_worker_rss_mb
+    rss_sample_interval = args.rss_sample_interval
+    warm_standby = args.warm_standby
+    zygote_mode = args.zygote
+    zygote_preload_models = args.zygote_preload_models
+    spare_ports = deque(args.spare_ports if args.spare_ports is not None else [8000 + len(ports) + 1])
+    pool_connection_limit = args.pool_limit or args.max_in_flight
+    max_queue_depth = args.max_queue_depth
+    max_queue_wait = args.max_queue_wait
+    client_quota = args.client_quota
+    default_request_timeout = args.request_timeout
+    batch_concurrency = args.batch_concurrency
+    micro_batch_max = args.micro_batch_max
+    micro_batch_window_ms = args.micro_batch_window_ms
+    micro_batch_max_kb = args.micro_batch_max_kb
+    jobs_enabled = args.jobs
+    job_path = args.job_path
+    job_concurrency = args.job_concurrency
+    job_max_attempts = args.job_max_attempts
+    job_max_pending = args.job_max_pending
+    job_retention = args.job_retention
+    cache_enabled = args.cache
+    single_flight = args.single_flight
+    cache_path = args.cache_path
+    cache_max_entries = args.cache_max_entries
+    cache_max_mb = args.cache_max_mb
+    cache_ttl = args.cache_ttl
+
+    uvicorn.run(app, host='0.0.0.0', port=args.port)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+    分块检测：超大扫描件、密集表格切成相互重叠的块分别检测，再合并接缝处的文本框
+
+    每块检测时 tr.c_img 只复制这一块，内存占用由块大小决定而不是整张图
+    除调用方自己的session外，再借用当前空闲的session并行检测各块
+    同一行文字在重叠区会被相邻两块各检测一次（或各检测到一截），
+    来自不同块、同一行且互相重叠的框合并成一个
+'''
+
+import queue
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+from tr import tr
+
+tile_size = 0  # 块的边长，图片最长边超过它时分块检测；0表示不分块
+tile_overlap = 200  # 相邻块的重叠宽度，应大于一行文字的高度
+
+MERGE_ANGLE = 10  # 角度相差不超过该值才可能是同一行
+MERGE_V_OVERLAP = 0.6  # 垂直于文字方向的重叠至少占较矮的框高度的比例
+
+
+def tile_starts(length, size, overlap):
+    '''
+    :return: 每块的起点，最后一块与边缘对齐
+    '''
+    if length <= size:
+        return [0]
+    step = max(size - overlap, 1)
+    starts = list(range(0, length - size, step))
+    starts.append(length - size)
+    return starts
+
+
+def tiles(height, width, size, overlap):
+    '''
+    :return: [(y0, x0, y1, x1)]
+    '''
+    return [(y0, x0, min(y0 + size, height), min(x0 + size, width))
+            for y0 in tile_starts(height, size, overlap)
+            for x0 in tile_starts(width, size, overlap)]
+
+
+_tile_executor = None
+_tile_executor_lock = threading.Lock()
+
+
+def _get_tile_executor():
+    # 与方向判定的并行尝试分开，尝试中的线程可以再提交分块任务而不会互相等待
+    global _tile_executor
+    with _tile_executor_lock:
+        if _tile_executor is None or _tile_executor._max_workers < tr.session_count():
+            _tile_executor = ThreadPoolExecutor(max_workers=tr.session_count(), thread_name_prefix='tile')
+        return _tile_executor
+
+
+def detect_tiled(img, ctpn_id=0, size=None, overlap=None):
+    '''
+    :return: (rects, tile_count)，rects 为整图坐标下的 [cx, cy, w, h, angle]，从上到下排列
+    '''
+    size = size or tile_size
+    overlap = tile_overlap if overlap is None else overlap
+    height, width = img.shape[:2]
+    boxes = tiles(height, width, size, overlap)
+
+    ctpn_ids = [ctpn_id]
+    borrowed = []
+    while len(ctpn_ids) < len(boxes):
+        try:
+            ids = tr.acquire_session(timeout=0)
+        except queue.Empty:
+            break
+        borrowed.append(ids)
+        ctpn_ids.append(ids[0])
+
+    pending = queue.Queue()
+    for index, box in enumerate(boxes):
+        pending.put((index, box))
+    results = [None] * len(boxes)
+
+    def run_lane(lane_ctpn_id):
+        while True:
+            try:
+                index, (y0, x0, y1, x1) = pending.get_nowait()
+            except queue.Empty:
+                return
+            rects = tr.detect(img[y0:y1, x0:x1], flag=tr.FLAG_ROTATED_RECT, ctpn_id=lane_ctpn_id)
+            results[index] = [[cx + x0, cy + y0, w, h, a] for cx, cy, w, h, a in rects]
+
+    try:
+        if len(ctpn_ids) == 1:
+            run_lane(ctpn_id)
+        else:
+            executor = _get_tile_executor()
+            futures = [executor.submit(contextvars.copy_context().run, run_lane, lane_ctpn_id)
+                       for lane_ctpn_id in ctpn_ids]
+            wait(futures)
+            for future in futures:
+                future.result()
+    finally:
+        for ids in borrowed:
+            tr.release_session(ids)
+
+    rects = merge(results, boxes, overlap)
+    rects.sort(key=lambda rect: (rect[1], rect[0]))
+    return rects, len(boxes)
+
+
+def _frame(rect):
+    cx, cy, w, h, a = rect[:5]
+    theta = np.deg2rad(a)
+    return cx, cy, w, h, np.cos(theta), np.sin(theta)
+
+
+def _project(rect, onto):
+    '''
+    rect 四个角点在 onto 的坐标系（沿文字方向为u，垂直方向为v）下的范围
+    :return: (u0, u1, v0, v1)
+    '''
+    cx, cy, w, h, cos, sin = _frame(rect)
+    ocx, ocy, _, _, ocos, osin = _frame(onto)
+    u = np.array([-w, w, w, -w]) / 2.
+    v = np.array([-h, -h, h, h]) / 2.
+    dx = cx + u * cos - v * sin - ocx
+    dy = cy + u * sin + v * cos - ocy
+    pu = dx * ocos + dy * osin
+    pv = -dx * osin + dy * ocos
+    return pu.min(), pu.max(), pv.min(), pv.max()
+
+
+def _same_line(a, b):
+    '''
+    a 为较大的框；两框角度接近、垂直方向大部分重叠、沿文字方向有重叠
+    '''
+    angle = abs(a[4] - b[4]) % 180
+    if min(angle, 180 - angle) > MERGE_ANGLE:
+        return False
+    u0, u1, v0, v1 = _project(b, a)
+    wa, ha = a[2] / 2., a[3] / 2.
+    v_overlap = min(v1, ha) - max(v0, -ha)
+    if v_overlap < MERGE_V_OVERLAP * min(a[3], v1 - v0):
+        return False
+    return min(u1, wa) - max(u0, -wa) > 0
+
+
+def _union(a, b):
+    '''
+    在 a 的坐标系下取两框的外接矩形，角度沿用 a
+    '''
+    u0, u1, v0, v1 = _project(b, a)
+    wa, ha = a[2] / 2., a[3] / 2.
+    u0, u1, v0, v1 = min(u0, -wa), max(u1, wa), min(v0, -ha), max(v1, ha)
+    cx, cy, _, _, cos, sin = _frame(a)
+    uc, vc = (u0 + u1) / 2., (v0 + v1) / 2.
+    return [cx + uc * cos - vc * sin, cy + uc * sin + vc * cos, u1 - u0, v1 - v0, a[4]]
+
+
+def _in_core(rect, box, cores):
+    # 外接矩形完全落在块的非重叠区域内，不可能被其他块重复检测
+    cx, cy, w, h, cos, sin = _frame(rect)
+    half_w = (abs(w * cos) + abs(h * sin)) / 2.
+    half_h = (abs(w * sin) + abs(h * cos)) / 2.
+    y0, x0, y1, x1 = cores[box]
+    return x0 <= cx - half_w and cx + half_w <= x1 and y0 <= cy - half_h and cy + half_h <= y1
+
+
+def merge(results, boxes, overlap):
+    '''
+    合并各块的检测结果：只有落在重叠区附近的框才参与合并，且只合并来自不同块的框
+    :param results: 每块的文本框列表（整图坐标）
+    :param boxes: 每块的 (y0, x0, y1, x1)
+    '''
+    height = max(box[2] for box in boxes)
+    width = max(box[3] for box in boxes)
+    cores = []
+    for y0, x0, y1, x1 in boxes:
+        # 块的内侧边缘向里缩进overlap，图片边缘不缩
+        cores.append((y0 + overlap if y0 > 0 else 0, x0 + overlap if x0 > 0 else 0,
+                      y1 - overlap if y1 < height else height, x1 - overlap if x1 < width else width))
+
+    kept, candidates = [], []
+    for index, rects in enumerate(results):
+        for rect in rects:
+            if _in_core(rect, index, cores):
+                kept.append(rect)
+            else:
+                candidates.append((rect, {index}))
+
+    # 面积大的先处理，小框并入大框
+    candidates.sort(key=lambda item: item[0][2] * item[0][3], reverse=True)
+    merged = []
+    for rect, sources in candidates:
+        for i, (other, other_sources) in enumerate(merged):
+            if not (sources & other_sources) and _same_line(other, rect):
+                merged[i] = (_union(other, rect), other_sources | sources)
+                break
+        else:
+            merged.append((rect, sources))
+
+    return kept + [rect for rect, _ in merged]
@@ -0,0 +1,73 @@
+# coding: utf-8
+import numpy as np
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+def parse(unicode_arr, prob_arr, num):
+    """
+    Reference CTC decoder for one line: collapse repeats, drop blanks (< 0)
+    and average the probability of the non-blank steps.
+    """
+    txt = ""
+    prob = 0.
+    unicode_pre = -1
+    count = 0
+    for pos in range(num):
+        unicode = unicode_arr[pos]
+        if unicode >= 0:
+            if unicode != unicode_pre:
+                txt += unichr(unicode)
+
+            count += 1
+            prob += prob_arr[pos]
+
+        unicode_pre = unicode
+
+    return txt, float(prob / max(count, 1))
+
+
+def parse_batch(unicode_arr, prob_arr, nums):
+    """
+    Vectorized `parse` over many lines at once, with identical results.
+    :param unicode_arr: (lines, width) int array, negative values are blanks
+    :param prob_arr: (lines, width) float array
+    :param nums: number of valid steps of each line
+    :return: list of (txt, confidence)
+    """
+    nums = np.asarray(nums, dtype=np.int64).reshape(-1)
+    if nums.size == 0:
+        return []
+
+    width = int(min(nums.max(), unicode_arr.shape[1])) if nums.max() > 0 else 0
+    unicode_arr = unicode_arr[:nums.size, :width]
+    prob_arr = prob_arr[:nums.size, :width]
+
+    valid = (np.arange(width)[None, :] < nums[:, None]) & (unicode_arr >= 0)
+    prev = np.empty_like(unicode_arr)
+    prev[:, :1] = -1
+    prev[:, 1:] = unicode_arr[:, :-1]
+    emit = valid & (unicode_arr != prev)
+
+    # `parse` adds float32 steps to a python float one by one; accumulate in the
+    # same dtype with a sequential cumsum (not a pairwise sum) to match it bit for bit
+    acc_dtype = (prob_arr.dtype.type(0) + 0.).dtype
+    count = valid.sum(axis=1)
+    if width > 0:
+        prob = np.cumsum(np.where(valid, prob_arr, 0), axis=1, dtype=acc_dtype)[:, -1]
+    else:
+        prob = np.zeros((nums.size,), dtype=acc_dtype)
+    confidence = prob / np.maximum(count, 1).astype(acc_dtype)
+
+    # every emitted code point is exactly one str character, so the text of all
+    # lines is decoded in one go and sliced by the per-line counts
+    codes = unicode_arr[emit].astype("<u4")
+    text = codes.tobytes().decode("utf-32-le", "surrogatepass")
+    ends = np.cumsum(emit.sum(axis=1)).tolist()
+    starts = [0] + ends[:-1]
+
+    return [(text[start:end], float(conf))
+            for start, end, conf in zip(starts, ends, confidence.tolist())]
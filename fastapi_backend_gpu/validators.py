@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+    文档校验器：判断某个方向的识别结果是否可信，按请求的 doc_type 选择
+
+    check(lines, total) 在每识别完一行后调用：
+        lines: 目前为止识别出的 [(txt, confidence)]
+        total: 本次一共要识别的行数，len(lines) == total 时为最终判定
+    返回 ACCEPT / REJECT / None(还不能确定)。提前 ACCEPT 后本方向继续识别完剩余行，
+    但不再尝试其他方向；提前 REJECT 则立即放弃本方向
+'''
+
+import re
+
+ACCEPT = 'accept'
+REJECT = 'reject'
+
+
+class KeywordValidator:
+    '''
+    任意一个关键字出现即通过
+    '''
+
+    def __init__(self, keywords):
+        self.keywords = tuple(keywords)
+
+    def check(self, lines, total):
+        text = '|'.join([txt for txt, _ in lines])
+        if any(keyword in text for keyword in self.keywords):
+            return ACCEPT
+        return REJECT if len(lines) >= total else None
+
+
+class RegexValidator:
+    '''
+    任意一行匹配正则即通过
+    '''
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+
+    def check(self, lines, total):
+        if any(self.pattern.search(txt) for txt, _ in lines):
+            return ACCEPT
+        return REJECT if len(lines) >= total else None
+
+
+class ConfidenceValidator:
+    '''
+    至少 min_lines 行的置信度不低于 min_confidence 即通过；剩余行数不够时提前拒绝
+    '''
+
+    def __init__(self, min_lines=3, min_confidence=0.8):
+        self.min_lines = min_lines
+        self.min_confidence = min_confidence
+
+    def check(self, lines, total):
+        passed = sum(1 for txt, confidence in lines if txt and confidence >= self.min_confidence)
+        # 总行数少于min_lines时，要求全部行都通过
+        required = min(self.min_lines, total)
+        if passed >= required and passed > 0:
+            return ACCEPT
+        if passed + (total - len(lines)) < required:
+            return REJECT
+        return None
+
+
+VALIDATORS = {
+    'business_license': KeywordValidator(('年', '登记', '统一', '营')),
+    'id_card': RegexValidator(r'\d{17}[\dXx]'),
+    'general': ConfidenceValidator(min_lines=3, min_confidence=0.8),
+}
+default_doc_type = 'business_license'
+
+
+def register(doc_type, validator):
+    VALIDATORS[doc_type] = validator
+
+
+def get(doc_type=None):
+    '''
+    :raise KeyError: 未注册的 doc_type
+    '''
+    return VALIDATORS[doc_type or default_doc_type]
+
+
+def check_text(validator, lines):
+    '''
+    对完整的识别结果做最终判定
+    '''
+    return validator.check(lines, len(lines)) == ACCEPT
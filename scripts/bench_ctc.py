@@ -0,0 +1,66 @@
+'''
+对比逐元素的 _parse 和向量化的 parse_batch：先校验结果完全一致，再比较耗时
+
+python scripts/bench_ctc.py [--lines 300] [--width 512] [--repeat 20]
+'''
+import argparse
+import importlib.util
+import os
+import time
+
+import numpy as np
+
+# 直接按路径加载 ctc.py，避免 import tr 包时加载 libtr.so 和模型
+_CTC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'tr', 'ctc.py')
+_spec = importlib.util.spec_from_file_location('ctc', _CTC_PATH)
+ctc = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ctc)
+
+
+def make_output(lines, width, seed=0):
+    '''
+    模拟 tr_run 的输出：空白(-1)和重复字符交替出现，每行有效长度不同
+    '''
+    rng = np.random.RandomState(seed)
+    unicode_arr = rng.randint(0x4e00, 0x4e00 + 50, size=(lines, width)).astype('int32')
+    unicode_arr[rng.rand(lines, width) < 0.4] = -1
+    repeat = rng.rand(lines, width) < 0.3
+    repeat[:, 0] = False
+    unicode_arr[repeat] = np.roll(unicode_arr, 1, axis=1)[repeat]
+    prob_arr = rng.rand(lines, width).astype('float32')
+    nums = rng.randint(0, width + 1, size=(lines,))
+    return unicode_arr, prob_arr, nums
+
+
+def bench(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark CTC decoding")
+    parser.add_argument('--lines', type=int, default=300)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    unicode_arr, prob_arr, nums = make_output(args.lines, args.width)
+
+    def loop():
+        return [ctc.parse(unicode_arr[i], prob_arr[i], nums[i]) for i in range(args.lines)]
+
+    def vectorized():
+        return ctc.parse_batch(unicode_arr, prob_arr, nums)
+
+    assert loop() == vectorized(), "parse_batch 与 parse 的结果不一致"
+
+    t_loop = bench(loop, args.repeat)
+    t_vec = bench(vectorized, args.repeat)
+    print(f"lines={args.lines} width={args.width}")
+    print(f"parse (loop):       {t_loop * 1000:.2f} ms")
+    print(f"parse_batch:        {t_vec * 1000:.2f} ms")
+    print(f"speedup:            {t_loop / t_vec:.1f}x")
@@ -0,0 +1,87 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+from backend.tools import batch
+
+
+def make_zip(files, compression=zipfile.ZIP_STORED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def corrupt_zip():
+    data = bytearray(make_zip([('a.png', b'0123456789')]))
+    # 改动存储的内容，CRC校验失败
+    offset = bytes(data).index(b'0123456789')
+    data[offset] ^= 0xff
+    return bytes(data)
+
+
+def result_lines(*lines):
+    return b''.join(json.dumps(line).encode() + b'\n' for line in lines)
+
+
+def test_expand_items_unpack():
+    items = batch.expand_items([('imgs.zip', make_zip([('a.png', b'a'), ('b.jpg', b'b')])), ('c.png', b'c')])
+    assert items == [('a.png', b'a', None), ('b.jpg', b'b', None), ('c.png', b'c', None)]
+
+
+def test_expand_items_without_unpack_keeps_uploads():
+    # 网关合并的单张请求可能是一个小zip，不解压才能与上传文件一一对应
+    archive = make_zip([('a.png', b'a'), ('b.jpg', b'b')])
+    items = batch.expand_items([('file', archive), ('c.png', b'c')], unpack=False)
+    assert items == [('file', archive, None), ('c.png', b'c', None)]
+
+
+def test_expand_items_bad_archive_is_one_item():
+    items = batch.expand_items([('x.png', b'x'), ('bad.zip', corrupt_zip()), ('y.png', b'y')])
+    assert [(name, data) for name, data, _ in items] == [('x.png', b'x'), ('bad.zip', None), ('y.png', b'y')]
+    assert items[1][2] is not None
+    with pytest.raises(batch.BatchError):
+        batch.expand_uploads([('bad.zip', corrupt_zip())])
+
+
+def test_expand_items_oversized_member(monkeypatch):
+    monkeypatch.setattr(batch, 'max_image_bytes', 4)
+    items = batch.expand_items([('imgs.zip', make_zip([('small.png', b'abc'), ('big.png', b'abcdef')]))])
+    assert items[0] == ('small.png', b'abc', None)
+    assert items[1][:2] == ('big.png', None) and items[1][2] is not None
+
+
+def test_expand_items_limit(monkeypatch):
+    monkeypatch.setattr(batch, 'max_batch_images', 2)
+    with pytest.raises(batch.BatchError):
+        batch.expand_items([('a.png', b'a'), ('b.png', b'b'), ('c.png', b'c')])
+
+
+def test_parse_result_lines_orders_by_index():
+    content = result_lines({'index': 1, 'status': 500, 'result': 'b'}, {'index': 0, 'status': 200, 'result': 'a'})
+    lines = batch.parse_result_lines(content, 2)
+    assert [(line['index'], line['result']) for line in lines] == [(0, 'a'), (1, 'b')]
+
+
+@pytest.mark.parametrize('lines', [
+    # 多出一行（例如子进程解压了压缩包）
+    [{'index': 0}, {'index': 1}, {'index': 2}],
+    [{'index': 0}, {'index': 0}],
+    [{'index': 0}],
+    [{'index': -1}, {'index': 1}],
+    [{'index': '0'}, {'index': 1}],
+])
+def test_parse_result_lines_rejects_mismatch(lines):
+    content = result_lines(*[dict(line, status=200, result={}) for line in lines])
+    with pytest.raises(batch.BatchError):
+        batch.parse_result_lines(content, 2)
+
+
+def test_parse_result_lines_rejects_malformed():
+    with pytest.raises(batch.BatchError):
+        batch.parse_result_lines(b'{"index": 0, "status": 200}\n', 1)
+    with pytest.raises(batch.BatchError):
+        batch.parse_result_lines(b'not json\n', 1)
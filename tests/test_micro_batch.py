@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('fastapi')
+pytest.importorskip('aiohttp')
+pytest.importorskip('loguru')
+
+import api_server  # noqa: E402
+
+
+def queued_request(loop, fields):
+    return None, loop.create_future(), time.monotonic(), None, api_server.micro_batch_item(fields)
+
+
+def test_micro_batch_item(monkeypatch):
+    monkeypatch.setattr(api_server, 'micro_batch_max', 4)
+    monkeypatch.setattr(api_server, 'micro_batch_max_kb', 1)
+    params = [('compress', b'0')]
+    assert api_server.micro_batch_item(params + [('file', b'a')]) == (params, ('file', b'a'))
+    assert api_server.micro_batch_item(params + [('file', b'a' * 2048)]) is None
+    assert api_server.micro_batch_item([('file', b'a'), ('file', b'b')]) is None
+    assert api_server.micro_batch_item([('file', b'a'), ('img', b'b')]) is None
+
+
+def test_collect_micro_batch_groups_in_order(monkeypatch):
+    monkeypatch.setattr(api_server, 'micro_batch_max', 4)
+    monkeypatch.setattr(api_server, 'micro_batch_window_ms', 0.)
+    monkeypatch.setattr(api_server, 'max_queue_wait', 0)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        monkeypatch.setattr(api_server, 'request_queue', asyncio.Queue())
+        first, second, other, last = [queued_request(loop, fields) for fields in (
+            [('compress', b'0'), ('file', b'1')],
+            [('compress', b'0'), ('file', b'2')],
+            [('compress', b'1'), ('file', b'3')],
+            [('compress', b'0'), ('file', b'4')],
+        )]
+        for queued in (second, other, last):
+            api_server.request_queue.put_nowait(queued)
+        group = await api_server.collect_micro_batch(first, first[4])
+        # 参数不同的请求结束这一批并放回队首，之后的请求不越过它
+        assert [queued for queued, _ in group] == [first, second]
+        assert [image for _, image in group] == [('file', b'1'), ('file', b'2')]
+        assert await api_server.next_request(0) is other
+        assert await api_server.next_request(0) is last
+
+    try:
+        asyncio.run(run())
+    finally:
+        api_server.deferred_requests.clear()
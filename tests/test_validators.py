@@ -0,0 +1,22 @@
+from backend.tools import validators
+
+
+def test_confidence_short_document_accepted():
+    validator = validators.ConfidenceValidator(min_lines=3, min_confidence=0.8)
+    # 只有2行、少于min_lines时，第一行之后还不能判定，两行都可信则通过
+    assert validator.check([('abc', .95)], 2) is None
+    assert validator.check([('abc', .95), ('def', .9)], 2) == validators.ACCEPT
+    assert validators.check_text(validator, [('abc', .95), ('def', .9)])
+
+
+def test_confidence_short_document_rejected():
+    validator = validators.ConfidenceValidator(min_lines=3, min_confidence=0.8)
+    assert validator.check([('abc', .3)], 2) == validators.REJECT
+    assert validator.check([('abc', .95), ('def', .3)], 2) == validators.REJECT
+
+
+def test_confidence_long_document():
+    validator = validators.ConfidenceValidator(min_lines=3, min_confidence=0.8)
+    assert validator.check([('a', .9), ('b', .9)], 5) is None
+    assert validator.check([('a', .9), ('b', .9), ('c', .9)], 5) == validators.ACCEPT
+    assert validator.check([('a', .1), ('b', .1), ('c', .1)], 5) == validators.REJECT